@@ -0,0 +1,158 @@
+# Open-loop load generator for /webhook and /small_form:
+#
+#     python bench/mock_ghl.py --port 9000 &
+#     API_KEY=bench PIPELINE_ID=bench-pipeline STAGE_ID=bench-stage URL_FIELD_ID=bench-url-field \
+#         GHL_URL=http://127.0.0.1:9000 uvicorn ghl:app --port 8000 &
+#     python bench/loadgen.py --rate 20 --duration 30 --mock http://127.0.0.1:9000
+#
+# Requests are sent on a fixed schedule whether or not earlier ones have
+# answered, so a slow service shows up as latency instead of a lower send
+# rate. With --mock, the mock's call counters give upstream calls per request.
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+
+
+def make_lead(index, returning_ratio, pool):
+    # returning leads resubmit with a known email/phone, the rest are new
+    if pool and random.random() < returning_ratio:
+        return random.choice(pool)
+    lead = {
+        "email": f"bench-{uuid.uuid4().hex[:10]}@example.com",
+        "name": f"Bench Lead {index}",
+        "phone": f"555{random.randint(0, 9999999):07d}",
+    }
+    pool.append(lead)
+    return lead
+
+
+def make_request(index, small_form_ratio, returning_ratio, pool):
+    lead = make_lead(index, returning_ratio, pool)
+    if random.random() < small_form_ratio:
+        return "/small_form", {"event": "bench", "data": {"name": lead["name"], "phone": lead["phone"]}}
+    data = {**lead, "comment": f"bench comment {index}"}
+    return "/webhook", {"event": "bench", "data": data, "utm_url": "https://example.com/?utm_source=bench"}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+async def send(client, path, body, results):
+    started = time.perf_counter()
+    try:
+        response = await client.post(path, json=body)
+        status = response.status_code
+        try:
+            outcome = response.json().get("status", "?")
+        except ValueError:
+            outcome = "invalid-json"
+    except httpx.HTTPError as e:
+        status, outcome = 0, type(e).__name__
+    results[path].append((time.perf_counter() - started, status, outcome))
+
+
+async def mock_stats(mock_url):
+    if not mock_url:
+        return None
+    async with httpx.AsyncClient(base_url=mock_url) as client:
+        return (await client.get("/_stats")).json()
+
+
+async def run(args):
+    results = defaultdict(list)
+    pool = []
+    before = await mock_stats(args.mock)
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=args.timeout) as client:
+        total = int(args.rate * args.duration)
+        interval = 1 / args.rate
+        tasks = []
+        started = time.perf_counter()
+        for index in range(total):
+            # fixed schedule; sleep until this request's send time
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            path, body = make_request(index, args.small_form_ratio, args.returning_ratio, pool)
+            tasks.append(asyncio.create_task(send(client, path, body, results)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    if args.drain:
+        # queue mode answers 202 before the GHL calls are made
+        await asyncio.sleep(args.drain)
+    after = await mock_stats(args.mock)
+    return results, elapsed, before, after
+
+
+def report(results, elapsed, before, after, as_json):
+    all_requests = sum(len(rows) for rows in results.values())
+    summary = {"elapsed_seconds": round(elapsed, 2), "requests": all_requests,
+               "throughput_rps": round(all_requests / elapsed, 2) if elapsed else 0.0, "endpoints": {}}
+    for path, rows in sorted(results.items()):
+        latencies = [row[0] * 1000 for row in rows]
+        summary["endpoints"][path] = {
+            "requests": len(rows),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "mean_ms": round(statistics.mean(latencies), 1) if latencies else 0.0,
+            "max_ms": round(max(latencies), 1) if latencies else 0.0,
+            "status_codes": dict(Counter(row[1] for row in rows)),
+            "outcomes": dict(Counter(row[2] for row in rows)),
+        }
+    if before is not None and after is not None:
+        upstream = after["total"] - before["total"]
+        summary["upstream_calls"] = upstream
+        summary["upstream_calls_per_request"] = round(upstream / all_requests, 2) if all_requests else 0.0
+        summary["upstream_calls_by_route"] = {
+            route: count - before["calls"].get(route, 0) for route, count in after["calls"].items()
+        }
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{all_requests} requests in {summary['elapsed_seconds']}s, {summary['throughput_rps']} req/s")
+    for path, row in summary["endpoints"].items():
+        print(f"  {path:12} n={row['requests']:<6} p50={row['p50_ms']}ms p95={row['p95_ms']}ms "
+              f"p99={row['p99_ms']}ms max={row['max_ms']}ms status={row['status_codes']} outcome={row['outcomes']}")
+    if "upstream_calls" in summary:
+        print(f"  upstream: {summary['upstream_calls']} calls, {summary['upstream_calls_per_request']} per request")
+        for route, count in sorted(summary["upstream_calls_by_route"].items()):
+            if count:
+                print(f"    {route}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive /webhook and /small_form at a fixed rate.")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="service under test")
+    parser.add_argument("--mock", help="mock GHL base URL, enables upstream call counts")
+    parser.add_argument("--rate", type=float, default=10.0, help="requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to send for")
+    parser.add_argument("--small-form-ratio", type=float, default=0.3, help="share of /small_form requests")
+    parser.add_argument("--returning-ratio", type=float, default=0.3, help="share of requests for known leads")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--drain", type=float, default=0.0, help="seconds to wait before reading mock counters")
+    parser.add_argument("--seed", type=int, help="random seed for a repeatable request mix")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    report(*asyncio.run(run(args)), as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# Local stand-in for the GoHighLevel v1 endpoints ghl.py uses, for load tests:
+#
+#     python bench/mock_ghl.py --port 9000 --latency-ms 150 --error-rate 0.01 --rate-limit 100
+#     API_KEY=bench PIPELINE_ID=bench-pipeline STAGE_ID=bench-stage URL_FIELD_ID=bench-url-field \
+#         GHL_URL=http://127.0.0.1:9000 uvicorn ghl:app --port 8000
+#
+# The mock has one pipeline, "Website leads" with the stage "New lead", and the
+# custom field "UTM URL", so PIPELINE_NAME / STAGE_NAME / URL_FIELD_NAME work
+# too. GET /_stats returns the upstream call counts, POST /_reset clears state.
+import argparse
+import asyncio
+import random
+import re
+import time
+import uuid
+from collections import Counter, deque
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+config = {
+    "latency_ms": 100.0,
+    "jitter_ms": 30.0,
+    "error_rate": 0.0,
+    "rate_limit": 0,
+    "rate_window": 10.0,
+    "retry_after": 2,
+}
+
+PIPELINES = [
+    {"id": "bench-pipeline", "name": "Website leads", "stages": [{"id": "bench-stage", "name": "New lead"}]},
+]
+CUSTOM_FIELDS = [
+    {"id": "bench-url-field", "name": "UTM URL", "fieldKey": "contact.utm_url", "dataType": "TEXT"},
+]
+
+contacts = {}
+opportunities = {}
+notes = Counter()
+calls = Counter()
+responses = Counter()
+recent_calls = deque()
+
+app = FastAPI()
+
+
+def e164(phone):
+    digits = re.sub(r"\D", "", phone or "")
+    if not digits:
+        return None
+    if (phone or "").strip().startswith("+") or len(digits) != 10:
+        return f"+{digits}"
+    return f"+1{digits}"
+
+
+@app.middleware("http")
+async def upstream_behaviour(request: Request, call_next):
+    if request.url.path.startswith("/_"):
+        return await call_next(request)
+    route = f"{request.method} {re.sub(r'/(?=[A-Za-z0-9-]*[0-9])[A-Za-z0-9-]{12,}', '/{id}', request.url.path)}"
+    calls[route] += 1
+
+    if config["rate_limit"]:
+        now = time.monotonic()
+        while recent_calls and now - recent_calls[0] > config["rate_window"]:
+            recent_calls.popleft()
+        if len(recent_calls) >= config["rate_limit"]:
+            responses[429] += 1
+            return JSONResponse(status_code=429, content={"msg": "Too many requests"},
+                                headers={"Retry-After": str(config["retry_after"])})
+        recent_calls.append(now)
+
+    delay = max(0.0, random.gauss(config["latency_ms"], config["jitter_ms"])) / 1000
+    await asyncio.sleep(delay)
+    if random.random() < config["error_rate"]:
+        responses[503] += 1
+        return JSONResponse(status_code=503, content={"msg": "Service unavailable"})
+    response = await call_next(request)
+    responses[response.status_code] += 1
+    return response
+
+
+#--------------------------
+#   CONTACTS
+# -------------------------
+@app.get("/v1/contacts/lookup")
+async def lookup(email: str = None, phone: str = None):
+    for contact in contacts.values():
+        if (email and contact.get("email") == email.lower()) or (phone and contact.get("phone") == e164(phone)):
+            return {"contacts": [contact]}
+    if email:
+        return JSONResponse(status_code=422, content={"email": {"message": "The email address is invalid."}})
+    return JSONResponse(status_code=422, content={"phone": {"message": "The phone number is invalid."}})
+
+
+@app.post("/v1/contacts/")
+async def create_contact(request: Request):
+    body = await request.json()
+    contact_id = uuid.uuid4().hex[:20]
+    contact = {
+        "id": contact_id,
+        "email": (body.get("email") or "").lower() or None,
+        "name": body.get("name"),
+        "phone": e164(body.get("phone")),
+        "customField": body.get("customField", {}),
+    }
+    contacts[contact_id] = contact
+    return {"contact": contact}
+
+
+@app.put("/v1/contacts/{contact_id}")
+async def update_contact(contact_id: str, request: Request):
+    contact = contacts.get(contact_id)
+    if contact is None:
+        return JSONResponse(status_code=404, content={"msg": "Contact not found"})
+    body = await request.json()
+    contact.update({k: v for k, v in body.items() if k != "phone"})
+    if body.get("phone"):
+        contact["phone"] = e164(body["phone"])
+    return {"contact": contact}
+
+
+@app.post("/v1/contacts/{contact_id}/notes/")
+async def add_note(contact_id: str, request: Request):
+    body = await request.json()
+    notes[contact_id] += 1
+    return {"id": uuid.uuid4().hex[:20], "body": body.get("body"), "contactId": contact_id}
+
+
+#--------------------------
+#   ACCOUNT SETUP
+# -------------------------
+@app.get("/v1/pipelines/")
+async def list_pipelines():
+    return {"pipelines": PIPELINES}
+
+
+@app.get("/v1/custom-fields/")
+async def list_custom_fields():
+    return {"customFields": CUSTOM_FIELDS}
+
+
+#--------------------------
+#   OPPORTUNITIES
+# -------------------------
+@app.get("/v1/pipelines/{pipeline_id}/opportunities")
+async def list_opportunities(pipeline_id: str, limit: int = 20, startAfterId: str = None):
+    deals = [deal for deal in opportunities.values() if deal["pipelineId"] == pipeline_id]
+    start = 0
+    if startAfterId:
+        ids = [deal["id"] for deal in deals]
+        start = ids.index(startAfterId) + 1 if startAfterId in ids else len(deals)
+    page = deals[start:start + limit]
+    has_next = start + limit < len(deals)
+    meta = {
+        "total": len(deals),
+        "currentPage": start // limit + 1,
+        "nextPage": start // limit + 2 if has_next else None,
+        "startAfterId": page[-1]["id"] if page and has_next else None,
+        "startAfter": int(time.time() * 1000) if has_next else None,
+    }
+    return {"opportunities": page, "meta": meta}
+
+
+@app.post("/v1/pipelines/{pipeline_id}/opportunities/")
+async def create_opportunity(pipeline_id: str, request: Request):
+    body = await request.json()
+    deal_id = uuid.uuid4().hex[:20]
+    deal = {**body, "id": deal_id, "pipelineId": pipeline_id, "contact": {"id": body.get("contactId")}}
+    opportunities[deal_id] = deal
+    return deal
+
+
+@app.put("/v1/pipelines/{pipeline_id}/opportunities/{deal_id}")
+async def update_opportunity(pipeline_id: str, deal_id: str, request: Request):
+    deal = opportunities.get(deal_id)
+    if deal is None:
+        return JSONResponse(status_code=404, content={"msg": "Opportunity not found"})
+    deal.update(await request.json())
+    return deal
+
+
+#--------------------------
+#   BENCH CONTROL
+# -------------------------
+@app.get("/_stats")
+async def stats():
+    return {
+        "total": sum(calls.values()),
+        "calls": dict(calls),
+        "responses": {str(status): count for status, count in responses.items()},
+        "contacts": len(contacts),
+        "opportunities": len(opportunities),
+        "notes": sum(notes.values()),
+    }
+
+
+@app.post("/_reset")
+async def reset():
+    for store in (contacts, opportunities, notes, calls, responses, recent_calls):
+        store.clear()
+    return {"status": "ok"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock GoHighLevel API for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=config["latency_ms"], help="mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=config["jitter_ms"], help="latency standard deviation")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"], help="fraction of 503 responses")
+    parser.add_argument("--rate-limit", type=int, default=config["rate_limit"],
+                        help="requests allowed per window before 429s (0 = unlimited)")
+    parser.add_argument("--rate-window", type=float, default=config["rate_window"], help="rate limit window, seconds")
+    parser.add_argument("--retry-after", type=int, default=config["retry_after"], help="Retry-After sent with 429s")
+    args = parser.parse_args()
+    config.update(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        retry_after=args.retry_after,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
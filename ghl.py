@@ -1,51 +1,128 @@
 from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, ValidationError
 import uvicorn
-import requests
+import asyncio
+import httpx
+import json
+import time
 from ghl_logging import *
+from ghl_dedup import LeadDeduplicator
+from ghl_metrics import (HANDLER_RESULTS, HANDLER_SECONDS, UPSTREAM_CALLS_PER_REQUEST, UPSTREAM_RESPONSES,
+                         UPSTREAM_RETRIES, UPSTREAM_SECONDS, mark_worker_dead, monitor_event_loop,
+                         prepare_multiprocess_metrics, register_stats_collector, render_metrics)
+from ghl_pipeline import Step, remaining_steps, run_steps
+from ghl_queue import JobQueue, JobWorkers
+from ghl_scheduler import GHLScheduler, create_scheduler
+from ghl_alerts import AlertDispatcher
+from ghl_cache import CacheBackend, ContactCache, OpportunityIndex, create_cache_backend, normalize_phone
+from ghl_settings import Settings, load_settings, resolve_ids
 import uuid
-from dotenv import load_dotenv
+import tempfile
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import os
 from typing import Optional
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from fastapi.middleware.cors import CORSMiddleware
 
+# GHL calls by operation made by the pipeline running in the current task, so
+# the saving from coalesced and idempotent requests can be counted
+upstream_calls: ContextVar[Optional[Counter]] = ContextVar("upstream_calls", default=None)
+
+
 class GoHighLevelAPI:
-    def __init__(self):
-        load_dotenv()
+    def __init__(self, settings: Settings, client: httpx.AsyncClient, cache_backend: CacheBackend,
+                 scheduler: GHLScheduler, alerts: AlertDispatcher):
+        self.client = client
+        self.scheduler = scheduler
+        self.alerts = alerts
+        self.contacts = ContactCache(cache_backend, ttl=settings.contact_cache_ttl)
+        self.opportunities = OpportunityIndex(cache_backend, ttl=settings.opportunity_index_ttl)
         # self.client = WebClient(token=os.getenv("SLACK_TOKEN"))
-        self.API_KEY = os.getenv("API_KEY")
-        self.URL = f"https://rest.gohighlevel.com"
-        self.headers = {
-            "Authorization": f"Bearer {self.API_KEY}",
-            "Version": "2021-04-15",
-            "Content-Type": "application/json"
-        }
+        self.API_KEY = settings.api_key
+        self.URL = settings.ghl_url
+        self.pipeline_id = settings.pipeline_id
+        self.stage_id = settings.stage_id
+        self.url_field_id = settings.url_field_id
+        self.headers = settings.ghl_headers
+
+    #--------------------------
+    #   GHL REQUEST
+    # -------------------------
+    async def _send(self, operation, method, url, **kwargs):
+        calls = upstream_calls.get()
+        if calls is not None:
+            calls[operation] += 1
+        started = time.perf_counter()
+        status = 0
+        try:
+            response = await self.scheduler.request(
+                method,
+                lambda: self.client.request(method, url, **kwargs),
+                on_retry=UPSTREAM_RETRIES.labels(operation).inc,
+            )
+            status = response.status_code
+            return response
+        finally:
+            UPSTREAM_SECONDS.labels(operation).observe(time.perf_counter() - started)
+            UPSTREAM_RESPONSES.labels(operation, str(status)).inc()
+
+    #--------------------------
+    #   UNCHANGED CHECKS
+    # -------------------------
+    def _with_url(self, contact):
+        # lookups return custom fields as a list of {id, value}
+        fields = contact.get("customField") or []
+        if isinstance(fields, dict):
+            url = fields.get(self.url_field_id)
+        else:
+            url = next((field.get("value") for field in fields if field.get("id") == self.url_field_id), None)
+        return {**contact, "url": url}
+
+    def contact_unchanged(self, contact, name, phone, url):
+        # only trusted when the cache knows every field the update would write
+        return (
+            url is not None
+            and contact.get("url") == url
+            and contact.get("name") == name
+            and normalize_phone(contact.get("phone")) == normalize_phone(phone)
+        )
+
+    def deal_unchanged(self, deal, title):
+        # listings return name/pipelineStageId, create/update echo title/stageId
+        return (
+            deal.get("name", deal.get("title")) == title
+            and deal.get("pipelineStageId", deal.get("stageId")) == self.stage_id
+            and deal.get("status") == "open"
+            and deal.get("pipelineId", self.pipeline_id) == self.pipeline_id
+        )
 
     #--------------------------
     # SLACK ERROR NOTIFICATIONS
     # ------------------------- 
     def send_slack_notification(self, message: str):
-        try:
-            webhook_url = os.getenv("SLACK_TOKEN")
-            payload = {"text": message}
-            response = requests.post(webhook_url, json=payload)
-            if response.status_code != 200:
-                error_logger.error(f"Slack webhook failed: {response.text}")
-        except Exception as e:
-            error_logger.error(f"Slack notification error: {str(e)}")
+        # queued; AlertDispatcher groups and posts them in the background
+        self.alerts.notify(message)
 
     #--------------------------
     #   SEARCH CONTACT(email)
     # ------------------------- 
-    def search_contact(self, email: str):
-        response = requests.get(f'{self.URL}/v1/contacts/lookup?email={email}', headers=self.headers)
+    async def search_contact(self, email: str):
+        contact = await self.contacts.get_by_email(email)
+        if contact is not None:
+            action_logger.info(f"Contact cache hit for email: {email}, id: {contact['id']}")
+            return {"contacts": [contact]}
+        response = await self._send("search_contact", "GET", f'{self.URL}/v1/contacts/lookup', params={'email': email}, headers=self.headers)
         try:
             result = response.json()
             action_logger.info(f"Searched contact by email: {email}, Result: {result}")
+            if response.is_success and result.get("contacts"):
+                await self.contacts.remember(self._with_url(result["contacts"][0]), email=email)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for search_contact: {str(e)}")
             self.send_slack_notification(f'Failed to decode JSON response for search_contact: {e}')
             return {"error": "Failed to decode JSON response"}
@@ -53,15 +130,21 @@ class GoHighLevelAPI:
     #--------------------------
     #   SEARCH CONTACT(phone)
     # ------------------------- 
-    def search_contact_small_form(self, phone: str):
-        phone = f'+1{phone}'
+    async def search_contact_small_form(self, phone: str):
+        phone = normalize_phone(phone)
+        contact = await self.contacts.get_by_phone(phone)
+        if contact is not None:
+            action_logger.info(f"Contact cache hit for phone: {phone}, id: {contact['id']}")
+            return {"contacts": [contact]}
         params={'phone': phone}
-        response = requests.get(f'{self.URL}/v1/contacts/lookup', params=params, headers=self.headers)
+        response = await self._send("search_contact_small_form", "GET", f'{self.URL}/v1/contacts/lookup', params=params, headers=self.headers)
         try:
             result = response.json()
             action_logger.info(f"Searched contact by phone: {phone}, Result: {result}")
+            if response.is_success and result.get("contacts"):
+                await self.contacts.remember(self._with_url(result["contacts"][0]), phone=phone)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for search_contact: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for search_contact: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -69,21 +152,23 @@ class GoHighLevelAPI:
     #--------------------------
     #   CREATE CONTACT(email)
     # ------------------------- 
-    def create_contact(self, email, name, phone, url):
+    async def create_contact(self, email, name, phone, url):
         data_raw = {
             "email": email,
             "name": name,
             "phone": phone,
             "customField": {
-                "npIW2acDJLVxtzLav4pg": url
+                self.url_field_id: url
             }
         }
-        response = requests.post(f'{self.URL}/v1/contacts/', headers=self.headers, json=data_raw)
+        response = await self._send("create_contact", "POST", f'{self.URL}/v1/contacts/', headers=self.headers, json=data_raw)
         try:
             result = response.json()
             action_logger.info(f"Contact created: {result}")
+            if response.is_success:
+                await self.contacts.remember({**(result.get("contact") or {}), "url": url}, email=email, phone=phone)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for create_contact: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for create_contact: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -91,20 +176,22 @@ class GoHighLevelAPI:
     #--------------------------
     #   CREATE CONTACT(phone)
     # ------------------------- 
-    def create_contact_small_form(self, name, phone, url):
+    async def create_contact_small_form(self, name, phone, url):
         data_raw = {
             "name": name,
             "phone": phone,
             "customField": {
-                "npIW2acDJLVxtzLav4pg": url
+                self.url_field_id: url
             }
         }
-        response = requests.post(f'{self.URL}/v1/contacts/', headers=self.headers, json=data_raw)
+        response = await self._send("create_contact_small_form", "POST", f'{self.URL}/v1/contacts/', headers=self.headers, json=data_raw)
         try:
             result = response.json()
             action_logger.info(f"Contact created: {result}")
+            if response.is_success:
+                await self.contacts.remember({**(result.get("contact") or {}), "url": url}, phone=phone)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for create_contact: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for create_contact: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -112,20 +199,28 @@ class GoHighLevelAPI:
     #--------------------------
     #       UPDATE CONTACT
     # ------------------------- 
-    def update_contact(self, id, name, phone, url):
+    async def update_contact(self, id, name, phone, url):
         data_raw = {
             "name": name,
             "phone": phone,
             "customField": {
-                "npIW2acDJLVxtzLav4pg": url
+                self.url_field_id: url
             }
         }
-        response = requests.put(f'{self.URL}/v1/contacts/{id}', headers=self.headers, json=data_raw)
+        response = await self._send("update_contact", "PUT", f'{self.URL}/v1/contacts/{id}', headers=self.headers, json=data_raw)
         try:
             result = response.json()
             action_logger.info(f"Contact updated: {result}")
+            if response.is_success:
+                contact = {**(result.get("contact") or {}), "id": id, "name": name, "url": url}
+                await self.contacts.remember(contact, phone=phone)
+            else:
+                # a 404 means the contact was deleted or merged: the cached id
+                # is dead under its email key too, not only under the phone
+                await self.contacts.forget_id(id)
+                await self.contacts.forget(phone=phone)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for update_contact: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for update_contact: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -133,38 +228,75 @@ class GoHighLevelAPI:
     #--------------------------
     #       SEARCH DEAL
     # ------------------------- 
-    def search_deal(self, contact_id):
-        response = requests.get(f'{self.URL}/v1/pipelines/UuhQYJN98JQKkWP0HcC6/opportunities', headers=self.headers)
-        try:
-            deals = response.json().get("opportunities", [])
-            for deal in deals:
-                if deal.get("contact", {}).get("id") == contact_id:
-                    action_logger.info(f"Deal found for contact_id={contact_id}: {deal}")
-                    return deal
-            action_logger.info(f"No deal found for contact_id={contact_id}")
+    async def search_deal(self, contact_id):
+        # waits only for the very first load; after that refresh_opportunities
+        # reloads in the background and a stale index is served meanwhile
+        if not self.opportunities.is_loaded():
+            error = await self.load_opportunities()
+            if error is not None:
+                return error
+        deal = await self.opportunities.get(contact_id)
+        if deal is not None:
+            action_logger.info(f"Deal found for contact_id={contact_id}: {deal}")
+            return deal
+        action_logger.info(f"No deal found for contact_id={contact_id}")
+        return None
+
+    #--------------------------
+    #   LOAD OPPORTUNITIES
+    # -------------------------
+    async def load_opportunities(self):
+        async with self.opportunities.lock:
+            # another request may have reloaded while we waited for the lock
+            if self.opportunities.is_fresh():
+                return None
+            listed_at = self.opportunities.begin_load()
+            deals = []
+            params = {"limit": 100}
+            while True:
+                response = await self._send("load_opportunities", "GET", f'{self.URL}/v1/pipelines/{self.pipeline_id}/opportunities', params=params, headers=self.headers)
+                try:
+                    result = response.json()
+                except json.JSONDecodeError as e:
+                    error_logger.error(f"Failed to decode JSON response for search_deal: {str(e)}")
+                    self.send_slack_notification(f"Failed to decode JSON response for search_deal: {str(e)}")
+                    return {"error": "Failed to decode JSON response"}
+                if not response.is_success:
+                    # never mark a partial listing as fresh, every lookup would miss
+                    error_logger.error(f"Failed to load opportunities: {response.status_code} {result}")
+                    return {"error": f"Failed to load opportunities: {response.status_code}"}
+                page = result.get("opportunities", [])
+                deals.extend(page)
+                meta = result.get("meta") or {}
+                has_next = meta.get("nextPage") or meta.get("nextPageUrl")
+                if len(page) < params["limit"] or not has_next or not meta.get("startAfterId"):
+                    break
+                params = {"limit": 100, "startAfterId": meta["startAfterId"]}
+                if meta.get("startAfter") is not None:
+                    params["startAfter"] = meta["startAfter"]
+            self.opportunities.replace(deals, listed_at)
+            action_logger.info(f"Opportunity index loaded: {self.opportunities.stats()}")
             return None
-        except requests.exceptions.JSONDecodeError as e:
-            error_logger.error(f"Failed to decode JSON response for search_deal: {str(e)}")
-            self.send_slack_notification(f"Failed to decode JSON response for search_deal: {str(e)}")
-            return {"error": "Failed to decode JSON response"}
 
     #--------------------------
     #   CREATE DEAL(email)
     # ------------------------- 
-    def create_deal(self, contact_id, email, name):
+    async def create_deal(self, contact_id, email, name):
         data = {
             "title": f"{email} - {name}",
             "status": "open",
-            "pipelineId": "UuhQYJN98JQKkWP0HcC6",
-            "stageId": "0eaab081-3e7a-4b46-8b35-0fd7135c1540",
+            "pipelineId": self.pipeline_id,
+            "stageId": self.stage_id,
             "contactId": contact_id,
         }
-        response = requests.post(f'{self.URL}/v1/pipelines/UuhQYJN98JQKkWP0HcC6/opportunities/', headers=self.headers, json=data)
+        response = await self._send("create_deal", "POST", f'{self.URL}/v1/pipelines/{self.pipeline_id}/opportunities/', headers=self.headers, json=data)
         try:
             result = response.json()
             action_logger.info(f"Deal created: {result}")
+            if response.is_success:
+                await self.opportunities.put(contact_id, result)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for create_deal: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for create_deal: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -172,20 +304,22 @@ class GoHighLevelAPI:
     #--------------------------
     #   CREATE DEAL(phone)
     # ------------------------- 
-    def create_deal_small_form(self, contact_id, phone, name):
+    async def create_deal_small_form(self, contact_id, phone, name):
         data = {
             "title": f"{phone} - {name}",
             "status": "open",
-            "pipelineId": "UuhQYJN98JQKkWP0HcC6",
-            "stageId": "0eaab081-3e7a-4b46-8b35-0fd7135c1540",
+            "pipelineId": self.pipeline_id,
+            "stageId": self.stage_id,
             "contactId": contact_id,
         }
-        response = requests.post(f'{self.URL}/v1/pipelines/UuhQYJN98JQKkWP0HcC6/opportunities/', headers=self.headers, json=data)
+        response = await self._send("create_deal_small_form", "POST", f'{self.URL}/v1/pipelines/{self.pipeline_id}/opportunities/', headers=self.headers, json=data)
         try:
             result = response.json()
             action_logger.info(f"Deal created: {result}")
+            if response.is_success:
+                await self.opportunities.put(contact_id, result)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             error_logger.error(f"Failed to decode JSON response for create_deal: {str(e)}")
             self.send_slack_notification(f"Failed to decode JSON response for create_deal: {str(e)}")
             return {"error": "Failed to decode JSON response"}
@@ -193,72 +327,210 @@ class GoHighLevelAPI:
     #--------------------------
     #       UPDATE DEAL(email)
     # ------------------------- 
-    def update_deal(self, deal_id, contact_id, email, name):
+    async def update_deal(self, deal_id, contact_id, email, name):
         data = {
             "title": f"{email} - {name}",
             "status": "open", 
-            "pipelineId": "UuhQYJN98JQKkWP0HcC6", 
-            "stageId": "0eaab081-3e7a-4b46-8b35-0fd7135c1540",
+            "pipelineId": self.pipeline_id, 
+            "stageId": self.stage_id,
             "contactId": contact_id
         }
-        response = requests.put(f'{self.URL}/v1/pipelines/UuhQYJN98JQKkWP0HcC6/opportunities/{deal_id}', headers=self.headers, json=data)
+        response = await self._send("update_deal", "PUT", f'{self.URL}/v1/pipelines/{self.pipeline_id}/opportunities/{deal_id}', headers=self.headers, json=data)
+        if response.status_code == 404:
+            # deleted or moved out of the pipeline in GHL: None tells the
+            # caller to create a new one
+            action_logger.info(f"Deal {deal_id} no longer in the pipeline, dropping it from the index")
+            await self.opportunities.drop(contact_id)
+            return None
         try:
             result = response.json()
             action_logger.info(f"Deal updated: {result}")
+            if response.is_success:
+                await self.opportunities.put(contact_id, result)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             self.send_slack_notification(f'Failed to decode JSON response for update_deal: {e}')
             error_logger.error(f"Failed to decode JSON response for update_deal: {str(e)}")
+            return {"error": "Failed to decode JSON response"}
 
 
     #--------------------------
     #       UPDATE DEAL(phone)
     # ------------------------- 
-    def update_deal_small_form(self, deal_id, contact_id, phone, name):
+    async def update_deal_small_form(self, deal_id, contact_id, phone, name):
         data = {
             "title": f"{phone} - {name}",
             "status": "open", 
-            "pipelineId": "UuhQYJN98JQKkWP0HcC6", 
-            "stageId": "0eaab081-3e7a-4b46-8b35-0fd7135c1540",
+            "pipelineId": self.pipeline_id, 
+            "stageId": self.stage_id,
             "contactId": contact_id
         }
-        response = requests.put(f'{self.URL}/v1/pipelines/UuhQYJN98JQKkWP0HcC6/opportunities/{deal_id}', headers=self.headers, json=data)
+        response = await self._send("update_deal_small_form", "PUT", f'{self.URL}/v1/pipelines/{self.pipeline_id}/opportunities/{deal_id}', headers=self.headers, json=data)
+        if response.status_code == 404:
+            # deleted or moved out of the pipeline in GHL: None tells the
+            # caller to create a new one
+            action_logger.info(f"Deal {deal_id} no longer in the pipeline, dropping it from the index")
+            await self.opportunities.drop(contact_id)
+            return None
         try:
             result = response.json()
             action_logger.info(f"Deal updated: {result}")
+            if response.is_success:
+                await self.opportunities.put(contact_id, result)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             self.send_slack_notification(f'Failed to decode JSON response for update_deal: {e}')
             error_logger.error(f"Failed to decode JSON response for update_deal: {str(e)}")
+            return {"error": "Failed to decode JSON response"}
 
     #--------------------------
     #       ADD NOTES
     # ------------------------- 
-    def add_notes(self, contact_id, comment_body):
+    async def add_notes(self, contact_id, comment_body):
         data = {
         "body": comment_body,
         "resourceType": "opportunity",
         "resourceId": contact_id
         }
 
-        response = requests.post(f'{self.URL}/v1/contacts/{contact_id}/notes/', headers=self.headers, json=data)
+        response = await self._send("add_notes", "POST", f'{self.URL}/v1/contacts/{contact_id}/notes/', headers=self.headers, json=data)
         try:
             result = response.json()
             action_logger.info(f"added notes: {result}")
-            print(f'res:{result}')
+            if response.status_code == 404:
+                # the update may have been skipped as unchanged, so this can be
+                # the first call to find out the cached contact is gone
+                await self.contacts.forget_id(contact_id)
             return result
-        except requests.exceptions.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
             self.send_slack_notification(f'Failed to decode JSON response for add_notes: {e}')
             error_logger.error(f"Failed to decode JSON response for add_notes: {str(e)}")
     
 
+    async def aclose(self):
+        await self.client.aclose()
+        if hasattr(self.contacts.backend, "close"):
+            self.contacts.backend.close()
+
+
+#--------------------------
+#   SHARED HTTP CLIENT
+# -------------------------
+def create_http_client(settings: Settings):
+    # one pooled client per worker: keep-alive connections to GHL are reused
+    # across webhooks instead of a new TCP+TLS handshake per call
+    limits = httpx.Limits(
+        max_connections=settings.ghl_max_connections,
+        max_keepalive_connections=settings.ghl_max_keepalive,
+        keepalive_expiry=30,
+    )
+    timeout = httpx.Timeout(settings.ghl_timeout, connect=10)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
 class WebhookData(BaseModel):
     event: str
     data: dict
     utm_url: Optional[str] = None
 
 
-app = FastAPI()
+#--------------------------
+#   APPLICATION CONTEXT
+# -------------------------
+class AppContext:
+    # everything that lives as long as the worker: built once from the
+    # validated settings at startup and torn down in reverse at shutdown
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.ghl_api: Optional[GoHighLevelAPI] = None
+        self.dedup: Optional[LeadDeduplicator] = None
+        self.job_queue: Optional[JobQueue] = None
+        self.job_workers: Optional[JobWorkers] = None
+        self.tasks = []
+
+    async def start(self):
+        start_logging(self.settings)
+        settings = self.settings
+        self.http_client = create_http_client(settings)
+        if settings.needs_resolving:
+            settings = self.settings = await resolve_ids(settings, self.http_client)
+        cache_backend = create_cache_backend(settings)
+        alerts = AlertDispatcher(
+            self.http_client,
+            settings.slack_token,
+            flush_interval=settings.slack_flush_interval,
+            max_per_hour=settings.slack_max_per_hour,
+            backend=cache_backend,
+        )
+        alerts.start()
+        self.ghl_api = GoHighLevelAPI(settings, self.http_client, cache_backend, create_scheduler(settings, cache_backend), alerts)
+        self.dedup = LeadDeduplicator(
+            cache_backend, window=settings.idempotency_window_minutes * 60, lease_ttl=settings.lead_lease_ttl
+        )
+        if settings.webhook_mode == "queue":
+            self.job_queue = JobQueue(settings.queue_sqlite_path, max_attempts=settings.queue_max_attempts)
+            replayed = self.job_queue.recover()
+            if replayed:
+                action_logger.info(f"Replaying {replayed} jobs interrupted by the previous shutdown")
+            self.job_workers = JobWorkers(
+                self.job_queue, run_job, concurrency=settings.queue_workers, retry_delay=settings.queue_retry_delay
+            )
+            self.job_workers.start()
+        self.tasks.append(asyncio.create_task(monitor_event_loop()))
+        # load the opportunity index in the background and keep reloading it,
+        # so no webhook pays for the full pipeline listing
+        self.tasks.append(asyncio.create_task(refresh_opportunities(self.ghl_api)))
+
+    async def stop(self):
+        # uvicorn has already stopped accepting and waited for open requests;
+        # what's left are pipelines whose caller went away and queued jobs
+        for task in self.tasks:
+            task.cancel()
+        if self.dedup is not None:
+            unfinished = await self.dedup.drain(timeout=self.settings.shutdown_timeout)
+            if unfinished:
+                error_logger.error(f"Shutting down with {unfinished} pipelines still running")
+        if self.job_workers is not None:
+            await self.job_workers.stop(drain_timeout=self.settings.shutdown_timeout)
+            self.job_queue.close()
+        if self.ghl_api is not None:
+            await self.ghl_api.alerts.stop()
+            await self.ghl_api.aclose()
+        elif self.http_client is not None:
+            await self.http_client.aclose()
+        mark_worker_dead()
+        stop_logging()
+
+
+async def refresh_opportunities(ghl_api: GoHighLevelAPI, retry_delay=30.0):
+    index = ghl_api.opportunities
+    while True:
+        try:
+            error = await ghl_api.load_opportunities()
+        except Exception as e:
+            error = e
+            error_logger.error(f"Opportunity index refresh failed: {str(e)}")
+        # a failed load is retried sooner, the old index is served until then
+        delay = index.ttl if error is None else min(index.ttl, retry_delay)
+        await asyncio.sleep(max(delay, 1.0))
+
+
+ctx: Optional[AppContext] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ctx
+    ctx = app.state.ctx = AppContext(load_settings())
+    try:
+        await ctx.start()
+        yield
+    finally:
+        await ctx.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -267,84 +539,263 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/webhook")
-async def webhook_endpoint(payload: WebhookData):
-    request_id = str(uuid.uuid4())
-    webhook_logger.info(f"Received webhook: {request_id} | {payload.model_dump_json()}")
-    action_logger.info(f"\n--- Request ID: {request_id} --- Data: {payload.model_dump_json()} ---")
-    error_logger.error(f"\n--- Request ID: {request_id} --- Data: {payload.model_dump_json()} ---")
+#--------------------------
+#   WEBHOOK PIPELINES
+# -------------------------
+def invalid_payload(payload: WebhookData, *fields):
+    # a submission without the fields a pipeline needs can't succeed on a
+    # retry, unlike a GHL failure
+    missing = [field for field in fields if field not in payload.data]
+    if not missing:
+        return None
+    message = f"payload is missing {', '.join(missing)}"
+    error_logger.error(f"Invalid webhook payload: {message}")
+    return {"status": "invalid", "message": message}
+
+
+async def process_webhook(payload: WebhookData, request_id: str, completed=()):
+    invalid = invalid_payload(payload, "comment", "email", "name", "phone")
+    if invalid is not None:
+        return invalid
+    ghl_api = ctx.ghl_api
     comment_body = payload.data["comment"]
     url = payload.utm_url
 
     try:
-        ghl_api = GoHighLevelAPI()
-        search_contact_ghl = ghl_api.search_contact(payload.data["email"])
+        search_contact_ghl = await ghl_api.search_contact(payload.data["email"])
 
         # contact doesn't exist
         if "email" in search_contact_ghl and search_contact_ghl["email"]["message"] == "The email address is invalid.":
             email, name, phone = payload.data["email"], payload.data["name"], payload.data["phone"]
-            new_contact = ghl_api.create_contact(email, name, phone, url)
+            new_contact = await ghl_api.create_contact(email, name, phone, url)
             contact_id = new_contact["contact"]["id"]
-            deal_data = ghl_api.create_deal(contact_id, email, name)
+            deal_data = await ghl_api.create_deal(contact_id, email, name)
             deal_id = deal_data["id"]
+            return {"status": "ok"}
 
-        # contact exists
-        else:
-            contact_id = search_contact_ghl["contacts"][0]["id"]
-            ghl_api.update_contact(contact_id, payload.data["name"], payload.data["phone"], url)
-            deal = ghl_api.search_deal(contact_id)
+        # contact exists: the contact update, the note and the deal lookup
+        # only need the contact id, so they run side by side
+        contact = search_contact_ghl["contacts"][0]
+        contact_id = contact["id"]
+        email, name, phone = payload.data["email"], payload.data["name"], payload.data["phone"]
+
+        async def save_deal(results):
+            deal = checked_deal(results["search_deal"])
             if deal is None:
-                deal_data = ghl_api.create_deal(contact_id, payload.data["email"], payload.data["name"])
-                deal_id = deal_data["id"]
-                ghl_api.add_notes(contact_id, comment_body)
+                deal_data = await ghl_api.create_deal(contact_id, email, name)
+            elif ghl_api.deal_unchanged(deal, f"{email} - {name}"):
+                action_logger.info(f"Deal {deal['id']} unchanged, skipping update")
+                return deal["id"]
             else:
-                deal_id = deal.get('id')
-                deal_data = ghl_api.update_deal(deal_id, contact_id, payload.data["email"], payload.data["name"])
-                deal_id = deal_data["id"]
-                ghl_api.add_notes(contact_id, comment_body)
+                deal_data = await ghl_api.update_deal(deal.get('id'), contact_id, email, name)
+                if deal_data is None:
+                    deal_data = await ghl_api.create_deal(contact_id, email, name)
+            return deal_data["id"]
 
-        return {"status": "ok"}
+        steps = contact_steps(ghl_api, contact, name, phone, url, save_deal)
+        # the v1 API takes one note per call, so a submission is one note
+        # and an empty comment none
+        if comment_body:
+            steps.append(Step("add_notes", lambda results: ghl_api.add_notes(contact_id, comment_body)))
+        return await run_contact_steps(request_id, contact_id, steps, completed)
     except Exception as e:
         error_logger.error(f"Error in webhook processing: {str(e)}")
         ghl_api.send_slack_notification(f'Error in webhook processing: {e}')
         return {"status": "error", "message": str(e)}
 
 
-@app.post("/small_form")
-async def webhook_small_form_endpoint(payload: WebhookData):
-    request_id = str(uuid.uuid4())
-    webhook_logger.info(f"Received webhook: {request_id} | {payload.model_dump_json()}")
-    action_logger.info(f"\n--- Request ID: {request_id} --- Data: {payload.model_dump_json()} ---")
-    error_logger.error(f"\n--- Request ID: {request_id} --- Data: {payload.model_dump_json()} ---")
+async def process_small_form(payload: WebhookData, request_id: str, completed=()):
+    invalid = invalid_payload(payload, "name", "phone")
+    if invalid is not None:
+        return invalid
+    ghl_api = ctx.ghl_api
     url = payload.utm_url
 
     try:
-        ghl_api = GoHighLevelAPI()
-        search_contact_ghl = ghl_api.search_contact_small_form(payload.data["phone"])
+        search_contact_ghl = await ghl_api.search_contact_small_form(payload.data["phone"])
 
         # contact doesn't exist
         if "phone" in search_contact_ghl and search_contact_ghl["phone"]["message"] == "The phone number is invalid.":
             name, phone = payload.data["name"], payload.data["phone"]
-            new_contact = ghl_api.create_contact_small_form(name, phone, url)
+            new_contact = await ghl_api.create_contact_small_form(name, phone, url)
             contact_id = new_contact["contact"]["id"]
-            ghl_api.create_deal_small_form(contact_id,  phone, name)
+            await ghl_api.create_deal_small_form(contact_id,  phone, name)
+            return {"status": "ok"}
 
         # contact exists
-        else:
-            contact_id = search_contact_ghl["contacts"][0]["id"]
-            ghl_api.update_contact(contact_id, payload.data["name"], payload.data["phone"], url)
-            deal = ghl_api.search_deal(contact_id)
+        contact = search_contact_ghl["contacts"][0]
+        contact_id = contact["id"]
+        name, phone = payload.data["name"], payload.data["phone"]
+
+        async def save_deal(results):
+            deal = checked_deal(results["search_deal"])
             if deal is None:
-                ghl_api.create_deal_small_form(contact_id, payload.data["phone"], payload.data["name"])
+                deal_data = await ghl_api.create_deal_small_form(contact_id, phone, name)
+            elif ghl_api.deal_unchanged(deal, f"{phone} - {name}"):
+                action_logger.info(f"Deal {deal['id']} unchanged, skipping update")
+                return deal["id"]
             else:
-                deal_id = deal.get('id')
-                ghl_api.update_deal_small_form(deal_id, contact_id, payload.data["phone"], payload.data["name"])
-        return {"status": "ok"}
-    
+                deal_data = await ghl_api.update_deal_small_form(deal.get('id'), contact_id, phone, name)
+                if deal_data is None:
+                    deal_data = await ghl_api.create_deal_small_form(contact_id, phone, name)
+            return deal_data["id"]
+
+        steps = contact_steps(ghl_api, contact, name, phone, url, save_deal)
+        return await run_contact_steps(request_id, contact_id, steps, completed)
+
     except Exception as e:
         error_logger.error(f"Error in webhook processing: {str(e)}")
         ghl_api.send_slack_notification(f'Error in webhook processing: {e}')
         return {"status": "error", "message": str(e)}
 
+
+def contact_steps(ghl_api: GoHighLevelAPI, contact, name, phone, url, save_deal):
+    # a returning lead that resubmits the same details costs no contact
+    # update, and a deal already at the right title/stage no deal update
+    contact_id = contact["id"]
+    steps = [
+        Step("search_deal", lambda results: ghl_api.search_deal(contact_id)),
+        Step("save_deal", save_deal, after=["search_deal"]),
+    ]
+    if ghl_api.contact_unchanged(contact, name, phone, url):
+        action_logger.info(f"Contact {contact_id} unchanged, skipping update")
+    else:
+        steps.insert(0, Step("update_contact", lambda results: ghl_api.update_contact(contact_id, name, phone, url)))
+    return steps
+
+
+def checked_deal(deal):
+    if deal is not None and "error" in deal:
+        raise RuntimeError(f"search_deal failed: {deal['error']}")
+    return deal
+
+
+async def run_contact_steps(request_id: str, contact_id, steps, completed=()):
+    if completed:
+        # a queued retry: a note already added must not be added twice
+        steps = remaining_steps(steps, completed)
+        action_logger.info(f"Retrying steps {[step.name for step in steps]}, {sorted(completed)} already done")
+    results, errors = await run_steps(steps, timeout=ctx.settings.pipeline_step_timeout)
+    if not errors:
+        return {"status": "ok"}
+    # look the contact up again next time rather than trust the cached id
+    await ctx.ghl_api.contacts.forget_id(contact_id)
+    failed = {name: str(e) or type(e).__name__ for name, e in errors.items()}
+    error_logger.error(f"Partial failure in webhook processing {request_id}: {failed}, completed: {sorted(results)}")
+    ctx.ghl_api.send_slack_notification(f'Partial failure in webhook processing: {failed}')
+    return {"status": "partial", "failed": failed, "completed": sorted(results)}
+
+
+PIPELINES = {
+    "webhook": process_webhook,
+    "small_form": process_small_form,
+}
+
+
+async def run_pipeline(kind: str, payload: WebhookData, request_id: str, completed=()):
+    async def pipeline():
+        calls = Counter()
+        upstream_calls.set(calls)
+        result = await PIPELINES[kind](payload, request_id, completed)
+        total = sum(calls.values())
+        UPSTREAM_CALLS_PER_REQUEST.labels(kind).observe(total)
+        action_logger.info(f"{kind} finished with status {result.get('status')} after {total} GHL calls: {dict(calls)}")
+        return result, total
+
+    return await ctx.dedup.run(kind, payload.model_dump(), pipeline)
+
+
+async def run_job(kind: str, request_id: str, payload: str, completed=()):
+    request_id_var.set(request_id)
+    action_logger.info(f"Processing queued {kind} job")
+    try:
+        payload = WebhookData.model_validate_json(payload)
+    except ValidationError as e:
+        return {"status": "invalid", "message": str(e)}
+    return await run_pipeline(kind, payload, request_id, completed)
+
+
+async def dispatch(kind: str, payload: WebhookData, request_id: str):
+    started = time.perf_counter()
+    status = "exception"
+    try:
+        if ctx.job_workers is None:
+            result = await run_pipeline(kind, payload, request_id)
+            status = result.get("status", "unknown")
+            return result
+        # acknowledge-then-process: the job is on disk before we answer 202
+        job_id = await asyncio.to_thread(ctx.job_queue.enqueue, kind, request_id, payload.model_dump_json())
+        ctx.job_workers.notify()
+        status = "accepted"
+        return JSONResponse(status_code=202, content={"status": "accepted", "request_id": request_id, "job_id": job_id})
+    finally:
+        HANDLER_SECONDS.labels(kind).observe(time.perf_counter() - started)
+        HANDLER_RESULTS.labels(kind, status).inc()
+
+
+@app.post("/webhook")
+async def webhook_endpoint(payload: WebhookData):
+    request_id = str(uuid.uuid4())
+    request_id_var.set(request_id)
+    webhook_logger.info("Received webhook", extra={"payload": payload.model_dump()})
+    return await dispatch("webhook", payload, request_id)
+
+
+@app.post("/small_form")
+async def webhook_small_form_endpoint(payload: WebhookData):
+    request_id = str(uuid.uuid4())
+    request_id_var.set(request_id)
+    webhook_logger.info("Received small form", extra={"payload": payload.model_dump()})
+    return await dispatch("small_form", payload, request_id)
+
+
+def collect_stats():
+    if ctx is None or ctx.ghl_api is None:
+        return {}
+    stats = {
+        "scheduler": ctx.ghl_api.scheduler.stats(),
+        "contacts": ctx.ghl_api.contacts.stats(),
+        "opportunities": ctx.ghl_api.opportunities.stats(),
+        "dedup": ctx.dedup.stats(),
+        "alerts": ctx.ghl_api.alerts.stats(),
+    }
+    if ctx.job_queue is not None:
+        stats["queue"] = ctx.job_queue.stats()
+    return stats
+
+
+register_stats_collector(collect_stats)
+
+
+@app.get("/stats")
+async def stats():
+    # the worker that took the request; only "queue" is shared by all of them
+    return {"pid": os.getpid(), **await asyncio.to_thread(collect_stats)}
+
+
+@app.get("/metrics")
+async def metrics():
+    # rendered off the loop, the queue stats read SQLite
+    body, content_type = await asyncio.to_thread(render_metrics)
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/queue/metrics")
+async def queue_metrics():
+    if ctx.job_queue is None:
+        return {"mode": "sync"}
+    stats = await asyncio.to_thread(ctx.job_queue.stats)
+    return {"mode": "queue", "workers": ctx.job_workers.concurrency, **stats}
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    settings = load_settings()
+    if settings.workers > 1:
+        prepare_multiprocess_metrics(settings.prometheus_multiproc_dir or tempfile.mkdtemp(prefix="ghl-metrics-"))
+    # an import string, so uvicorn can start the app in each worker process
+    uvicorn.run(
+        "ghl:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=settings.workers,
+        timeout_graceful_shutdown=settings.shutdown_timeout,
+    )
@@ -0,0 +1,118 @@
+import asyncio
+import re
+import time
+
+import httpx
+
+from ghl_cache import CacheBackend, MemoryBackend
+from ghl_logging import *
+
+
+def alert_signature(message: str):
+    # ids, numbers and quoted values vary between otherwise identical errors
+    signature = re.sub(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "<id>", message)
+    signature = re.sub(r"'[^']*'|\"[^\"]*\"", "<value>", signature)
+    return re.sub(r"\d+", "<n>", signature)
+
+
+#--------------------------
+#   SLACK ALERTS
+# -------------------------
+class AlertDispatcher:
+    # notify() only records the alert; a background task posts one grouped
+    # Slack message per flush interval, within an hourly message budget
+    def __init__(self, client: httpx.AsyncClient, webhook_url, flush_interval=10.0, max_per_hour=30,
+                 max_groups=20, backend: CacheBackend = None):
+        self.client = client
+        # the hourly budget lives in the cache backend so that with a shared
+        # backend all workers spend one budget between them
+        self.backend = backend or MemoryBackend()
+        self.webhook_url = webhook_url
+        self.flush_interval = flush_interval
+        self.max_per_hour = max_per_hour
+        self.max_groups = max_groups
+        self._groups = {}
+        self._task = None
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self._dropped_unreported = 0
+
+    def notify(self, message: str):
+        self.received += 1
+        signature = alert_signature(message)
+        group = self._groups.get(signature)
+        if group is not None:
+            group["count"] += 1
+        elif len(self._groups) < self.max_groups:
+            self._groups[signature] = {"message": message, "count": 1, "first_seen": time.time()}
+        else:
+            self.dropped += 1
+            self._dropped_unreported += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                error_logger.error(f"Slack alert flush failed: {str(e)}")
+
+    async def _take_budget(self):
+        def change(sent_at):
+            now = time.time()
+            sent_at = [sent for sent in sent_at or [] if now - sent < 3600]
+            if len(sent_at) >= self.max_per_hour:
+                return sent_at, False
+            return sent_at + [now], True
+        return await self.backend.aupdate("alerts:sent_at", change, 3600)
+
+    async def flush(self):
+        if not self._groups:
+            return
+        groups, self._groups = self._groups, {}
+        alerts = sum(group["count"] for group in groups.values())
+        if not await self._take_budget():
+            # over budget: the batch is dropped but reported in the next message
+            self.dropped += alerts
+            self._dropped_unreported += alerts
+            action_logger.info(f"Slack alert budget exhausted, dropped {alerts} alerts")
+            return
+        lines = []
+        for group in groups.values():
+            prefix = f"({group['count']}x) " if group["count"] > 1 else ""
+            lines.append(f"{prefix}{group['message']}")
+        if self._dropped_unreported:
+            lines.append(f"({self._dropped_unreported} alerts dropped over budget since the last message)")
+        self._dropped_unreported = 0
+        await self._post("\n".join(lines))
+        self.sent += alerts
+
+    async def _post(self, text):
+        if not self.webhook_url:
+            error_logger.error(f"Slack webhook not configured, alert: {text}")
+            return
+        try:
+            response = await self.client.post(self.webhook_url, json={"text": text})
+            if response.status_code != 200:
+                error_logger.error(f"Slack webhook failed: {response.text}")
+        except Exception as e:
+            error_logger.error(f"Slack notification error: {str(e)}")
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "pending_groups": len(self._groups),
+        }
@@ -0,0 +1,400 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Optional
+
+
+#--------------------------
+#   KEY NORMALISATION
+# -------------------------
+def normalize_email(email):
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+def normalize_phone(phone):
+    # E.164; bare 10 digit numbers are assumed to be North American
+    if not phone:
+        return None
+    phone = str(phone).strip()
+    digits = re.sub(r"\D", "", phone)
+    if not digits:
+        return None
+    if phone.startswith("+"):
+        return f"+{digits}"
+    if len(digits) == 10:
+        return f"+1{digits}"
+    return f"+{digits}"
+
+
+#--------------------------
+#   CACHE BACKENDS
+# -------------------------
+class CacheBackend:
+    # values must be JSON serialisable so every backend can store them.
+    # shared backends are seen by every worker process on the host
+    shared = False
+    # only cached GHL data is evicted to stay under maxsize; leases,
+    # idempotency results and the rate limit state just expire
+    evictable_prefixes = ("contact:", "opportunity:")
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        # stores value only if key is absent or expired, True if it did
+        raise NotImplementedError
+
+    def update(self, key, change, ttl):
+        # atomic read-modify-write: change(value or None) -> (new value, result).
+        # A new value of None deletes the key, the same object leaves it as is
+        raise NotImplementedError
+
+    # the event loop uses these; a backend that does I/O runs them off the loop
+    async def aget(self, key):
+        return await self._offload(self.get, key)
+
+    async def aset(self, key, value, ttl):
+        return await self._offload(self.set, key, value, ttl)
+
+    async def adelete(self, key):
+        return await self._offload(self.delete, key)
+
+    async def aadd(self, key, value, ttl):
+        return await self._offload(self.add, key, value, ttl)
+
+    async def aupdate(self, key, change, ttl):
+        return await self._offload(self.update, key, change, ttl)
+
+    async def _offload(self, method, *args):
+        # in-process backends answer inline
+        return method(*args)
+
+
+class MemoryBackend(CacheBackend):
+    # per-process LRU with a TTL per entry
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            # least recently used first
+            evictable = (k for k in self._data if k.startswith(self.evictable_prefixes))
+            for k in list(islice(evictable, len(self._data) - self.maxsize)):
+                del self._data[k]
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def add(self, key, value, ttl):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, ttl)
+        return True
+
+    def update(self, key, change, ttl):
+        current = self.get(key)
+        value, result = change(current)
+        if value is None:
+            self.delete(key)
+        elif value is not current:
+            self.set(key, value, ttl)
+        return result
+
+
+class SqliteBackend(CacheBackend):
+    # local stand-in for a shared store: every uvicorn worker on the host
+    # opens the same file
+    shared = True
+
+    def __init__(self, path="cache.sqlite3", maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # one thread: the calls serialise on the connection anyway, and a busy
+        # wait for another worker's write lock never blocks the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-sqlite")
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl),
+            )
+            self._writes += 1
+            if self._writes % 500 == 0:
+                self._prune()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now + ttl),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def update(self, key, change, ttl):
+        # BEGIN IMMEDIATE takes the write lock up front, so no other worker
+        # can read the old value between our read and write
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                current = json.loads(row[0]) if row else None
+                value, result = change(current)
+                if value is None:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                elif value is not current:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, json.dumps(value), now + ttl),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _prune(self):
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        evictable = " OR ".join("key LIKE ?" for _ in self.evictable_prefixes)
+        patterns = [f"{prefix}%" for prefix in self.evictable_prefixes]
+        self._conn.execute(
+            f"DELETE FROM cache WHERE ({evictable}) AND key NOT IN "
+            f"(SELECT key FROM cache WHERE {evictable} ORDER BY expires_at DESC LIMIT ?)",
+            (*patterns, *patterns, self.maxsize),
+        )
+
+    async def _offload(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+
+
+def create_cache_backend(settings):
+    if settings.cache_backend == "sqlite":
+        return SqliteBackend(settings.cache_sqlite_path, maxsize=settings.cache_size)
+    return MemoryBackend(maxsize=settings.cache_size)
+
+
+#--------------------------
+#   CONTACT CACHE
+# -------------------------
+class ContactCache:
+    # normalised email / E.164 phone -> contact, only positive lookups are
+    # cached so a new lead is never hidden behind a stale "not found"
+    def __init__(self, backend: CacheBackend, ttl: float = 900):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def _get(self, key):
+        if key is None:
+            return None
+        contact = await self.backend.aget(key)
+        if contact is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return contact
+
+    async def get_by_email(self, email):
+        email = normalize_email(email)
+        return await self._get(f"contact:email:{email}" if email else None)
+
+    async def get_by_phone(self, phone):
+        phone = normalize_phone(phone)
+        return await self._get(f"contact:phone:{phone}" if phone else None)
+
+    async def remember(self, contact, email=None, phone=None):
+        if not contact or not contact.get("id"):
+            return
+        entry = {key: contact.get(key) for key in ("id", "email", "phone", "name", "url") if contact.get(key) is not None}
+        email = normalize_email(email or contact.get("email"))
+        phone = normalize_phone(phone or contact.get("phone"))
+        keys = []
+        if email:
+            keys.append(f"contact:email:{email}")
+        if phone:
+            keys.append(f"contact:phone:{phone}")
+        for key in keys:
+            await self.backend.aset(key, entry, self.ttl)
+        if keys:
+            # every key that points at this id, so forget_id() finds them all
+            await self.backend.aupdate(
+                f"contact:keys:{contact['id']}", lambda known: (sorted(set(known or []) | set(keys)), None), self.ttl
+            )
+
+    async def forget(self, email=None, phone=None):
+        email = normalize_email(email)
+        phone = normalize_phone(phone)
+        if email:
+            await self.backend.adelete(f"contact:email:{email}")
+        if phone:
+            await self.backend.adelete(f"contact:phone:{phone}")
+
+    async def forget_id(self, contact_id):
+        # the contact was deleted or merged in GHL: drop it under every key
+        keys = await self.backend.aget(f"contact:keys:{contact_id}") or []
+        for key in keys + [f"contact:keys:{contact_id}"]:
+            await self.backend.adelete(key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+#--------------------------
+#   OPPORTUNITY INDEX
+# -------------------------
+class OpportunityIndex:
+    # contact_id -> opportunity for one pipeline, filled by a full paginated
+    # load and kept current by create/update deal results. With a shared
+    # backend the results are published too, so a deal another worker just
+    # created is found before this worker's next full load
+    def __init__(self, backend: CacheBackend, ttl: float = 300):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = asyncio.Lock()
+        self._by_contact = {}
+        self._loaded_at: Optional[float] = None
+        # wall clock start of the listing behind _by_contact, comparable with
+        # the time on entries other workers published
+        self._listed_at = 0.0
+        # put()/drop() made while a listing is fetched: newer than the listing
+        self._changes: Optional[dict] = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def is_loaded(self):
+        return self._loaded_at is not None
+
+    def is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def begin_load(self):
+        self._changes = {}
+        return time.time()
+
+    def replace(self, opportunities, listed_at=None):
+        index = {}
+        for deal in opportunities:
+            contact_id = deal.get("contact", {}).get("id")
+            # the pipeline listing returns the oldest match first, keep it
+            if contact_id and contact_id not in index:
+                index[contact_id] = deal
+        for contact_id, deal in (self._changes or {}).items():
+            if deal is None:
+                index.pop(contact_id, None)
+            else:
+                index[contact_id] = deal
+        self._changes = None
+        self._by_contact = index
+        self._listed_at = listed_at or time.time()
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    async def get(self, contact_id):
+        deal = self._by_contact.get(contact_id)
+        if self.backend.shared:
+            # whichever is newer: another worker's write or our last listing
+            entry = await self.backend.aget(f"opportunity:contact:{contact_id}")
+            if entry is not None and entry.get("at", 0) > self._listed_at:
+                deal = entry.get("deal")
+        if deal is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return deal
+
+    async def put(self, contact_id, deal):
+        if contact_id and deal and deal.get("id"):
+            await self._set(contact_id, deal)
+
+    async def drop(self, contact_id):
+        # the deal is gone from the pipeline in GHL
+        if contact_id:
+            await self._set(contact_id, None)
+
+    async def _set(self, contact_id, deal):
+        if deal is None:
+            self._by_contact.pop(contact_id, None)
+        else:
+            self._by_contact[contact_id] = deal
+        if self._changes is not None:
+            self._changes[contact_id] = deal
+        if self.backend.shared:
+            # outlives one reload interval so every worker has reloaded since;
+            # a dropped deal is published too, or other workers' listings would
+            # keep serving it
+            entry = {"deal": deal, "at": time.time()}
+            await self.backend.aset(f"opportunity:contact:{contact_id}", entry, self.ttl * 2)
+
+    def stats(self):
+        return {
+            "size": len(self._by_contact),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "fresh": self.is_fresh(),
+        }
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import json
+import uuid
+from contextlib import asynccontextmanager
+
+from ghl_cache import CacheBackend, normalize_email, normalize_phone
+from ghl_logging import *
+
+
+def lead_key(data: dict):
+    # the same identity the pipeline looks the contact up by
+    email = normalize_email(data.get("email"))
+    if email:
+        return f"email:{email}"
+    phone = normalize_phone(data.get("phone"))
+    if phone:
+        return f"phone:{phone}"
+    return None
+
+
+def payload_fingerprint(kind: str, payload: dict):
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{kind}|{body}".encode()).hexdigest()
+
+
+#--------------------------
+#   LEAD DEDUPLICATION
+# -------------------------
+class LeadDeduplicator:
+    # identical payloads share one in-flight pipeline and are answered from
+    # the idempotency window afterwards; different payloads for the same lead
+    # run one at a time so the second sees the contact/deal the first created
+    def __init__(self, backend: CacheBackend, window: float = 600, lease_ttl: float = 120):
+        self.backend = backend
+        self.window = window
+        self.lease_ttl = lease_ttl
+        self._inflight = {}
+        self._lead_locks = {}
+        self.coalesced = 0
+        self.idempotent_hits = 0
+        self.calls_saved = 0
+
+    async def run(self, kind, payload: dict, pipeline):
+        # pipeline() -> (result, upstream call count)
+        fingerprint = payload_fingerprint(kind, payload)
+        cached = await self._cached(kind, fingerprint)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(fingerprint)
+        if task is not None:
+            self.coalesced += 1
+            result, calls = await asyncio.shield(task)
+            self.calls_saved += calls
+            action_logger.info(f"Coalesced concurrent {kind} payload, saved {calls} GHL calls")
+            return result
+
+        task = asyncio.create_task(self._run_serialised(kind, lead_key(payload.get("data") or {}), fingerprint, pipeline))
+        self._inflight[fingerprint] = task
+        task.add_done_callback(lambda _: self._inflight.pop(fingerprint, None))
+        # shielded so a disconnecting client doesn't cancel work others wait on
+        result, _ = await asyncio.shield(task)
+        return result
+
+    async def _cached(self, kind, fingerprint):
+        cached = await self.backend.aget(f"idempotency:{fingerprint}")
+        if cached is None:
+            return None
+        self.idempotent_hits += 1
+        self.calls_saved += cached["calls"]
+        action_logger.info(f"Duplicate {kind} payload inside idempotency window, saved {cached['calls']} GHL calls")
+        return cached["result"]
+
+    async def _run_serialised(self, kind, key, fingerprint, pipeline):
+        if key is None:
+            return await self._run(fingerprint, pipeline)
+        entry = self._lead_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._lead_lease(key):
+                    # the same payload may have finished on another worker
+                    # while we waited for the lease
+                    cached = await self._cached(kind, fingerprint)
+                    if cached is not None:
+                        return cached, 0
+                    return await self._run(fingerprint, pipeline)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._lead_locks.pop(key, None)
+
+    @asynccontextmanager
+    async def _lead_lease(self, key):
+        # the lock above serialises a lead within this worker; the lease in the
+        # shared backend extends that to every worker. It expires on its own
+        # if the worker holding it dies
+        lease_key = f"lease:lead:{key}"
+        token = uuid.uuid4().hex
+        delay = 0.02
+        while not await self.backend.aadd(lease_key, token, self.lease_ttl):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        try:
+            yield
+        finally:
+            # only our own lease: an expired one may have been taken over
+            await self.backend.aupdate(lease_key, lambda current: (None if current == token else current, None), self.lease_ttl)
+
+    async def drain(self, timeout=None):
+        # pipelines are shielded from their requests, so a shutdown has to
+        # wait for them explicitly
+        tasks = list(self._inflight.values())
+        if not tasks:
+            return 0
+        action_logger.info(f"Waiting for {len(tasks)} in-flight pipelines")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return len(pending)
+
+    async def _run(self, fingerprint, pipeline):
+        result, calls = await pipeline()
+        # errors are not remembered, a retry from the form provider should run
+        if isinstance(result, dict) and result.get("status") == "ok":
+            await self.backend.aset(f"idempotency:{fingerprint}", {"result": result, "calls": calls}, self.window)
+        return result, calls
+
+    def stats(self):
+        return {
+            "coalesced": self.coalesced,
+            "idempotent_hits": self.idempotent_hits,
+            "upstream_calls_saved": self.calls_saved,
+        }
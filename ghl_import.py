@@ -0,0 +1,173 @@
+# Replay historical form submissions into GHL:
+#
+#     python ghl_import.py submissions.jsonl --concurrency 8
+#     python ghl_import.py logs/webhook.log --dry-run
+#
+# Each line is a WebhookData record, a JSON webhook.log entry, or a line of
+# the older plain text webhook.log ("<time> - Received webhook: <id> | {...}").
+# Lines that went through are appended to a checkpoint file, so an interrupted
+# import resumes where it stopped.
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+from pydantic import ValidationError
+
+import ghl
+from ghl_logging import *
+from ghl_settings import load_settings
+
+
+# written before the JSON log format; both forms were logged the same way,
+# so the pipeline is picked from the payload
+LEGACY_LOG_LINE = re.compile(r"^.*? - Received webhook: \S+ \| (?P<payload>\{.*\})\s*$")
+
+
+def parse_record(line: str, form: str):
+    legacy = LEGACY_LOG_LINE.match(line)
+    record = json.loads(legacy.group("payload") if legacy else line)
+    kind = record.get("kind")
+    if "payload" in record:
+        # webhook.log entry
+        if kind is None and record.get("message") == "Received small form":
+            kind = "small_form"
+        record = record["payload"]
+    payload = ghl.WebhookData.model_validate(record)
+    if form != "auto":
+        kind = form
+    elif kind not in ghl.PIPELINES:
+        kind = "webhook" if payload.data.get("email") else "small_form"
+    return kind, payload
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+class ImportStats:
+    def __init__(self):
+        self.read = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.ok = 0
+        self.failed = 0
+        self.by_kind = {}
+        self.started = time.monotonic()
+
+    def report(self, dry_run):
+        elapsed = time.monotonic() - self.started
+        done = self.ok + self.failed
+        lines = [
+            f"lines read:     {self.read}",
+            f"skipped (done): {self.skipped}",
+            f"invalid:        {self.invalid}",
+            f"by form:        {self.by_kind}",
+        ]
+        if not dry_run:
+            scheduler = ghl.ctx.ghl_api.scheduler.stats()
+            lines += [
+                f"imported:       {self.ok}",
+                f"failed:         {self.failed}",
+                f"elapsed:        {elapsed:.1f}s",
+                f"throughput:     {done / elapsed if elapsed else 0:.2f} leads/s",
+                f"GHL calls:      {scheduler['calls']} ({scheduler['calls'] / done if done else 0:.2f} per lead)",
+                f"GHL retries:    {scheduler['retries']} ({scheduler['throttled']} throttled)",
+                f"calls saved:    {ghl.ctx.dedup.stats()['upstream_calls_saved']}",
+            ]
+        print("\n".join(lines))
+
+
+async def produce(path, form, done, stats: ImportStats, queue: asyncio.Queue = None, workers=0):
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            stats.read += 1
+            if lineno in done:
+                stats.skipped += 1
+                continue
+            try:
+                kind, payload = parse_record(line, form)
+            except (ValueError, ValidationError) as e:
+                stats.invalid += 1
+                error_logger.error(f"Import line {lineno} is not a valid submission: {str(e)}")
+                continue
+            stats.by_kind[kind] = stats.by_kind.get(kind, 0) + 1
+            if queue is not None:
+                # bounded queue: the file is streamed, never loaded whole
+                await queue.put((lineno, kind, payload))
+    for _ in range(workers):
+        await queue.put(None)
+
+
+async def consume(queue: asyncio.Queue, checkpoint, stats: ImportStats):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        lineno, kind, payload = item
+        request_id = f"import-{lineno}"
+        request_id_var.set(request_id)
+        result = await ghl.run_pipeline(kind, payload, request_id)
+        if isinstance(result, dict) and result.get("status") == "ok":
+            stats.ok += 1
+            checkpoint.write(f"{lineno}\n")
+            checkpoint.flush()
+        else:
+            stats.failed += 1
+            error_logger.error(f"Import line {lineno} failed: {result}")
+
+
+async def run_import(settings, path, form, checkpoint_path, concurrency, stats: ImportStats):
+    done = read_checkpoint(checkpoint_path)
+    ghl.ctx = ghl.AppContext(settings)
+    try:
+        await ghl.ctx.start()
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        with open(checkpoint_path, "a") as checkpoint:
+            await asyncio.gather(
+                produce(path, form, done, stats, queue, concurrency),
+                *[consume(queue, checkpoint, stats) for _ in range(concurrency)],
+            )
+    finally:
+        await ghl.ctx.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay form submissions into GoHighLevel.")
+    parser.add_argument("path", help="JSONL file of WebhookData records, or a webhook.log in the JSON or the "
+                                     "older '<time> - Received webhook: <id> | {...}' format")
+    parser.add_argument("--form", choices=["auto", "webhook", "small_form"], default="auto",
+                        help="pipeline to use; auto picks small_form for records without an email")
+    parser.add_argument("--concurrency", type=int, default=8, help="leads in flight at once")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="validate and count records without calling GHL")
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or f"{args.path}.checkpoint"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    # replayed leads go straight through the pipeline, never through the queue
+    settings = load_settings(webhook_mode="sync")
+    stats = ImportStats()
+    try:
+        if args.dry_run:
+            # invalid lines are still written to errors.log
+            start_logging(settings)
+            asyncio.run(produce(args.path, args.form, read_checkpoint(checkpoint_path), stats))
+        else:
+            asyncio.run(run_import(settings, args.path, args.form, checkpoint_path, args.concurrency, stats))
+    except KeyboardInterrupt:
+        print("interrupted, re-run the same command to resume")
+    stats.report(args.dry_run or ghl.ctx is None or ghl.ctx.ghl_api is None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,128 @@
+import atexit
+import gzip
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from contextvars import ContextVar
+
+# set by the endpoints and queue workers, stamped on every log line
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    # runs in the calling task, where the context var is visible
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per line; runs on the listener thread, so the payload
+    # attached with extra={"payload": ...} is serialised there, once
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            entry["payload"] = payload
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def file_handler(settings, filename, level):
+    if settings.workers > 1:
+        # rotation renames the file under the other writers, so with several
+        # worker processes each one writes its own files
+        stem, ext = os.path.splitext(filename)
+        filename = f"{stem}.{os.getpid()}{ext}"
+    path = os.path.join(settings.log_dir, filename)
+    if settings.log_rotation == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=settings.log_rotate_when, backupCount=settings.log_backup_count, encoding="utf-8", delay=True
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=settings.log_max_bytes, backupCount=settings.log_backup_count, encoding="utf-8", delay=True
+        )
+    handler.namer = lambda name: f"{name}.gz"
+    handler.rotator = gzip_rotator
+    handler.setLevel(level)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
 
 # logs settings
 logging.basicConfig(level=logging.INFO)
+# httpx logs every request at INFO through the synchronous root handler
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RequestIdFilter())
 
-# logs for webhook
 webhook_logger = logging.getLogger("webhook_logger")
-webhook_handler = logging.FileHandler("logs/webhook.log")
-webhook_handler.setLevel(logging.INFO)
-webhook_formatter = logging.Formatter('%(asctime)s - %(message)s')
-webhook_handler.setFormatter(webhook_formatter)
-webhook_logger.addHandler(webhook_handler)
-
-# logs for errors
 error_logger = logging.getLogger("error_logger")
-error_handler = logging.FileHandler("logs/errors.log")
-error_handler.setLevel(logging.ERROR)
-error_formatter = logging.Formatter('%(asctime)s - %(message)s')
-error_handler.setFormatter(error_formatter)
-error_logger.addHandler(error_handler)
-
-# logs for actions
 action_logger = logging.getLogger("action_logger")
-action_handler = logging.FileHandler("logs/actions.log")
-action_handler.setLevel(logging.INFO)
-action_formatter = logging.Formatter('%(asctime)s - %(message)s')
-action_handler.setFormatter(action_formatter)
-action_logger.addHandler(action_handler)
\ No newline at end of file
+
+for _logger in (webhook_logger, error_logger, action_logger):
+    _logger.setLevel(logging.INFO)
+    _logger.addHandler(queue_handler)
+    # the console copy goes through the listener too
+    _logger.propagate = False
+
+log_listener = None
+
+
+def start_logging(settings):
+    # the handlers come from the loaded settings (LOG_* and WORKERS); lines
+    # logged before this wait in the queue and are written once it runs
+    global log_listener
+    if log_listener is not None:
+        return
+    os.makedirs(settings.log_dir, exist_ok=True)
+
+    # logs for webhook
+    webhook_handler = file_handler(settings, "webhook.log", logging.INFO)
+    webhook_handler.addFilter(logging.Filter("webhook_logger"))
+
+    # logs for errors
+    error_handler = file_handler(settings, "errors.log", logging.ERROR)
+    error_handler.addFilter(logging.Filter("error_logger"))
+
+    # logs for actions
+    action_handler = file_handler(settings, "actions.log", logging.INFO)
+    action_handler.addFilter(logging.Filter("action_logger"))
+
+    handlers = [webhook_handler, error_handler, action_handler]
+    if settings.log_console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(request_id)s - %(message)s'))
+        handlers.append(console_handler)
+    # file and console writes happen on the listener thread, off the event loop
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_logging():
+    # flushes whatever is still queued; safe to call more than once
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from ghl_logging import *
+
+
+#--------------------------
+#   METRICS
+# -------------------------
+# with WORKERS > 1 the parent sets PROMETHEUS_MULTIPROC_DIR before the workers
+# import this module: the counters and histograms below are then written to
+# files there and /metrics on any worker adds up every worker's samples
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+if MULTIPROCESS:
+    # set in the real environment the parent imports this before preparing it
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+UPSTREAM_SECONDS = Histogram(
+    "ghl_upstream_request_seconds",
+    "GHL call latency per operation, including scheduler wait and retries",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+UPSTREAM_RESPONSES = Counter(
+    "ghl_upstream_responses",
+    "GHL calls by operation and final status code (0 = no response)",
+    ["operation", "status"],
+)
+UPSTREAM_RETRIES = Counter("ghl_upstream_retries", "GHL retries per operation", ["operation"])
+UPSTREAM_CALLS_PER_REQUEST = Histogram(
+    "ghl_upstream_calls_per_request",
+    "GHL calls made by one pipeline run",
+    ["endpoint"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10),
+)
+HANDLER_SECONDS = Histogram(
+    "webhook_handler_seconds",
+    "End-to-end handler time",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+HANDLER_RESULTS = Counter("webhook_requests", "Handled requests by result status", ["endpoint", "status"])
+# a gauge per live worker, labelled with its pid when there are several
+LOOP_LAG = Gauge("event_loop_lag_seconds", "Most recent event loop scheduling delay", multiprocess_mode="liveall")
+LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds_distribution",
+    "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+# stats() keys that go up and down; every other numeric value is a counter
+GAUGE_KEYS = {
+    "size", "fresh", "queued", "depth", "delayed", "running", "pending_groups", "queue_wait_max_seconds",
+    "oldest_pending_age_seconds", "lag_last_seconds", "lag_avg_seconds", "lag_max_seconds", "workers", "processes",
+}
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class StatsCollector:
+    # exposes the stats() dicts of the caches, scheduler, dedup, alerts and
+    # queue at scrape time, so the hot path keeps its plain attribute counters.
+    # These are the state of the worker that answered the scrape, labelled
+    # with its pid; only the queue section is the same for every worker
+    def __init__(self, collect):
+        self.collect_stats = collect
+        self.pid = str(os.getpid())
+
+    def collect(self):
+        try:
+            sections = self.collect_stats()
+        except Exception as e:
+            error_logger.error(f"Metrics collection failed: {str(e)}")
+            return
+        for section, stats in sections.items():
+            for key, value in stats.items():
+                name = f"ghl_{section}_{key}"
+                if key == "circuit_state":
+                    metric = GaugeMetricFamily(name, "0 closed, 1 half open, 2 open", labels=["pid"])
+                    value = CIRCUIT_STATES[value]
+                elif not isinstance(value, (bool, int, float)):
+                    continue
+                elif key in GAUGE_KEYS:
+                    metric = GaugeMetricFamily(name, f"{section} {key}", labels=["pid"])
+                else:
+                    metric = CounterMetricFamily(name, f"{section} {key}", labels=["pid"])
+                metric.add_metric([self.pid], float(value))
+                yield metric
+
+
+_stats_collector = None
+
+
+def register_stats_collector(collect):
+    global _stats_collector
+    _stats_collector = StatsCollector(collect)
+    if not MULTIPROCESS:
+        REGISTRY.register(_stats_collector)
+
+
+async def monitor_event_loop(interval=0.5):
+    # a sleep that wakes late means something blocked the loop
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+def render_metrics():
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    # a fresh registry per scrape, as MultiProcessCollector reads the files
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    if _stats_collector is not None:
+        registry.register(_stats_collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def prepare_multiprocess_metrics(path):
+    # called by the parent before it starts the workers; samples left by a
+    # previous run would otherwise be added to this one's
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def mark_worker_dead():
+    # drops this worker's live gauges; its counters keep counting in the total
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
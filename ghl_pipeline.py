@@ -0,0 +1,69 @@
+import asyncio
+
+
+class StepSkipped(Exception):
+    pass
+
+
+#--------------------------
+#   PIPELINE STEPS
+# -------------------------
+class Step:
+    # run(results) is called with the results of the steps it runs after
+    def __init__(self, name, run, after=(), timeout=None):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.timeout = timeout
+
+
+def remaining_steps(steps, completed):
+    # for a retry: drops the steps an earlier attempt got through, except
+    # those a step that still has to run needs the result of
+    keep = {step.name for step in steps if step.name not in completed}
+    while True:
+        needed = {dep for step in steps if step.name in keep for dep in step.after} - keep
+        if not needed:
+            return [step for step in steps if step.name in keep]
+        keep |= needed
+
+
+async def run_steps(steps, timeout=30.0):
+    # starts every step as soon as the steps it depends on have succeeded;
+    # returns (results, errors) so callers can report a partial failure
+    pending = {step.name: step for step in steps}
+    results = {}
+    errors = {}
+    running = {}
+
+    def start_ready():
+        for name, step in list(pending.items()):
+            failed = [dep for dep in step.after if dep in errors]
+            if failed:
+                errors[name] = StepSkipped(f"skipped, {', '.join(failed)} failed")
+                del pending[name]
+            elif all(dep in results for dep in step.after):
+                task = asyncio.ensure_future(asyncio.wait_for(step.run(results), step.timeout or timeout))
+                running[task] = step
+                del pending[name]
+
+    try:
+        start_ready()
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                step = running.pop(task)
+                try:
+                    results[step.name] = task.result()
+                except asyncio.TimeoutError:
+                    errors[step.name] = asyncio.TimeoutError(f"timed out after {step.timeout or timeout}s")
+                except Exception as e:
+                    errors[step.name] = e
+            start_ready()
+        # an unknown dependency would leave steps behind
+        for name in pending:
+            errors[name] = StepSkipped("skipped, dependencies never completed")
+    finally:
+        for task in running:
+            task.cancel()
+    return results, errors
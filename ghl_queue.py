@@ -0,0 +1,290 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from ghl_logging import *
+
+
+#--------------------------
+#   DURABLE JOB QUEUE
+# -------------------------
+class JobQueue:
+    # jobs are journaled to SQLite before the webhook is acknowledged;
+    # rows are never deleted on completion so the table doubles as history
+    def __init__(self, path="queue.sqlite3", max_attempts=3, stale_after=30.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        # every worker process sharing the file claims jobs under its own
+        # owner id and heartbeats it; running jobs of an owner that stopped
+        # heartbeating are replayed
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # an acknowledged job must survive a power loss
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                request_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        if "not_before" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+        if "completed" not in columns:
+            # JSON list of the pipeline steps earlier attempts got through
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN completed TEXT")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue_owners (owner TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)"
+        )
+        self.processed = 0
+        self.failed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.last_lag = 0.0
+
+    def enqueue(self, kind, request_id, payload):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (kind, request_id, payload, enqueued_at) VALUES (?, ?, ?, ?)",
+                (kind, request_id, payload, time.time()),
+            )
+            return cursor.lastrowid
+
+    def heartbeat(self):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queue_owners (owner, heartbeat_at) VALUES (?, ?)", (self.owner, time.time())
+            )
+
+    def recover(self):
+        # jobs left running by a crashed process are replayed, unless they
+        # already crashed the process max_attempts times. Jobs of live
+        # owners, other workers included, are left alone
+        orphaned = (
+            "status = 'running' AND owner IS NOT ? AND (owner IS NULL OR owner NOT IN "
+            "(SELECT owner FROM queue_owners WHERE heartbeat_at > ?))"
+        )
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                alive_since = time.time() - self.stale_after
+                self._conn.execute(
+                    f"UPDATE jobs SET status = 'failed', error = 'max attempts exceeded' "
+                    f"WHERE {orphaned} AND attempts >= ?",
+                    (self.owner, alive_since, self.max_attempts),
+                )
+                cursor = self._conn.execute(
+                    f"UPDATE jobs SET status = 'pending' WHERE {orphaned}", (self.owner, alive_since)
+                )
+                self._conn.execute("DELETE FROM queue_owners WHERE heartbeat_at <= ?", (alive_since,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return cursor.rowcount
+
+    def claim(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, kind, request_id, payload, attempts, enqueued_at, completed FROM jobs "
+                    "WHERE status = 'pending' AND (not_before IS NULL OR not_before <= ?) ORDER BY id LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                now = time.time()
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, owner = ? "
+                    "WHERE id = ?",
+                    (now, self.owner, row[0]),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        lag = now - row[5]
+        self.last_lag = lag
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "request_id": row[2],
+            "payload": row[3],
+            "attempts": row[4] + 1,
+            "completed": json.loads(row[6]) if row[6] else [],
+        }
+
+    def complete(self, job_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ?, error = NULL WHERE id = ?",
+                (time.time(), job_id),
+            )
+        self.processed += 1
+
+    def fail(self, job_id, error, retry=False, delay=0.0, completed=None):
+        # a retried job goes back to pending but isn't claimed before delay;
+        # completed steps are recorded so the retry doesn't repeat them
+        status = "pending" if retry else "failed"
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ?, not_before = ?, "
+                "completed = COALESCE(?, completed) WHERE id = ?",
+                (status, now, error, now + delay if retry else None,
+                 json.dumps(completed) if completed is not None else None, job_id),
+            )
+        if not retry:
+            self.failed += 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest, delayed = self._conn.execute(
+                "SELECT MIN(enqueued_at), COUNT(not_before > ? OR NULL) FROM jobs WHERE status = 'pending'",
+                (time.time(),),
+            ).fetchone()
+            processes = self._conn.execute(
+                "SELECT COUNT(*) FROM queue_owners WHERE heartbeat_at > ?", (time.time() - self.stale_after,)
+            ).fetchone()[0]
+        started = self.processed + self.failed
+        return {
+            "depth": counts.get("pending", 0),
+            "delayed": delayed,
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_pending_age_seconds": time.time() - oldest if oldest else 0.0,
+            "lag_last_seconds": self.last_lag,
+            "lag_avg_seconds": self.lag_total / started if started else 0.0,
+            "lag_max_seconds": self.lag_max,
+            "processes": processes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM queue_owners WHERE owner = ?", (self.owner,))
+            self._conn.close()
+
+
+#--------------------------
+#   BACKGROUND WORKERS
+# -------------------------
+class JobWorkers:
+    # handler(kind, request_id, payload, completed) runs the contact/deal/note
+    # pipeline, skipping the steps named in completed
+    def __init__(self, queue: JobQueue, handler, concurrency=4, poll_interval=1.0, retry_delay=30.0):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._drain_until = 0.0
+        self._tasks = []
+        self._maintenance = None
+
+    def start(self):
+        self.queue.heartbeat()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+        self._maintenance = asyncio.create_task(self._maintain())
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def stop(self, drain_timeout=0.0):
+        # workers finish the job they hold and keep taking pending jobs until
+        # the queue is empty or drain_timeout runs out, then exit; anything
+        # left stays on disk for the next process
+        self._drain_until = time.monotonic() + drain_timeout
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            await asyncio.gather(self._maintenance, return_exceptions=True)
+
+    def _claiming(self):
+        return not self._stopping or time.monotonic() < self._drain_until
+
+    async def _maintain(self):
+        # keeps this process's jobs claimed and replays those of a worker
+        # process that died while others kept running
+        while True:
+            await asyncio.sleep(self.queue.stale_after / 3)
+            try:
+                await asyncio.to_thread(self.queue.heartbeat)
+                replayed = await asyncio.to_thread(self.queue.recover)
+                if replayed:
+                    action_logger.info(f"Replaying {replayed} jobs left running by a stopped worker process")
+                    self.notify()
+            except Exception as e:
+                error_logger.error(f"Queue maintenance failed: {str(e)}")
+
+    async def _run(self):
+        while self._claiming():
+            # cleared before claiming so an enqueue during the claim isn't missed
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                if self._stopping:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _process(self, job):
+        try:
+            result = await self.handler(job["kind"], job["request_id"], job["payload"], job["completed"])
+        except Exception as e:
+            await self._retry_or_fail(job, f"crashed: {str(e)}")
+            return
+        status = result.get("status") if isinstance(result, dict) else None
+        if status == "invalid":
+            # a payload the pipeline can't use fails the same way every time
+            error_logger.error(f"Job {job['id']} ({job['request_id']}) rejected: {result.get('message')}")
+            await asyncio.to_thread(self.queue.fail, job["id"], result.get("message"))
+        elif status in ("error", "partial"):
+            # the pipelines catch their own exceptions, so a GHL outage, an
+            # open circuit or a step timeout lands here; the webhook was
+            # already acknowledged, so the job has to be retried by us
+            completed = sorted(set(job["completed"]) | set(result.get("completed", [])))
+            await self._retry_or_fail(job, result.get("message") or str(result.get("failed")), completed)
+        else:
+            await asyncio.to_thread(self.queue.complete, job["id"])
+
+    async def _retry_or_fail(self, job, error, completed=None):
+        retry = job["attempts"] < self.queue.max_attempts
+        delay = self.retry_delay * 2 ** (job["attempts"] - 1) if retry else 0.0
+        error_logger.error(
+            f"Job {job['id']} ({job['request_id']}) attempt {job['attempts']} failed, "
+            f"{f'retrying in {delay:.0f}s' if retry else 'giving up'}: {error}"
+        )
+        await asyncio.to_thread(self.queue.fail, job["id"], error, retry, delay, completed)
@@ -0,0 +1,311 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from ghl_cache import CacheBackend
+from ghl_logging import *
+
+
+WRITE = 0
+READ = 1
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+#--------------------------
+#   TOKEN BUCKET
+# -------------------------
+class TokenBucket:
+    # async only to match SharedTokenBucket, nothing here waits
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self):
+        # takes a token and returns 0, or returns how long to wait for one
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def pause(self, seconds):
+        # GHL told us to back off: nobody gets a token until it's over
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    async def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class SharedTokenBucket:
+    # the same bucket kept in a shared cache backend, so every worker on the
+    # host draws from one GHL budget. Wall clock time: workers don't share a
+    # monotonic clock
+    def __init__(self, backend: CacheBackend, rate: float, capacity: float, key="ratelimit:ghl"):
+        self.backend = backend
+        self.rate = rate
+        self.capacity = capacity
+        self.key = key
+
+    async def _update(self, change):
+        def apply(state):
+            now = time.time()
+            state = dict(state) if state else {"tokens": self.capacity, "updated": now, "paused_until": 0.0}
+            return state, change(state, now)
+        # an idle bucket is full again, the key may as well expire
+        return await self.backend.aupdate(self.key, apply, ttl=3600)
+
+    async def take(self):
+        def change(state, now):
+            if now < state["paused_until"]:
+                return state["paused_until"] - now
+            state["tokens"] = min(self.capacity, state["tokens"] + max(0.0, now - state["updated"]) * self.rate)
+            state["updated"] = now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0.0
+            return (1 - state["tokens"]) / self.rate
+        return await self._update(change)
+
+    async def pause(self, seconds):
+        def change(state, now):
+            state["paused_until"] = max(state["paused_until"], now + seconds)
+            state["tokens"] = 0
+            state["updated"] = state["paused_until"]
+        await self._update(change)
+
+    async def refund(self):
+        def change(state, now):
+            state["tokens"] = min(self.capacity, state["tokens"] + 1)
+        await self._update(change)
+
+
+#--------------------------
+#   CIRCUIT BREAKER
+# -------------------------
+class CircuitBreaker:
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        # returns True for the one trial call let through while half open
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        raise CircuitOpenError(f"GHL circuit open after {self.failures} consecutive failures")
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial_in_flight or self.failures >= self.threshold:
+            if self.opened_at is None or self.trial_in_flight:
+                error_logger.error(f"GHL circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def release(self):
+        # a trial call that ended without a verdict (e.g. a 429)
+        self.trial_in_flight = False
+
+
+def retry_after_seconds(response: httpx.Response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+#--------------------------
+#   GHL SCHEDULER
+# -------------------------
+class GHLScheduler:
+    # every GHL call waits here for a token; writes are served before reads
+    # so a burst of lookups can't starve the creates/updates behind them
+    def __init__(self, rate=9.0, burst=10, max_retries=4, base_delay=0.5, max_delay=30.0,
+                 breaker: CircuitBreaker = None, bucket=None):
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.transport_errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def acquire(self, priority=READ):
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    async def _dispatch(self):
+        while self._waiters:
+            if self._waiters[0][2].done():
+                # caller was cancelled while queued
+                heapq.heappop(self._waiters)
+                continue
+            wait = await self.bucket.take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                await self.bucket.refund()
+                continue
+            future.set_result(None)
+
+    def _backoff(self, attempt):
+        # full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _retryable(self, method, status=None, error=None):
+        if error is not None:
+            # a write may have reached GHL unless the connection never opened
+            return method == "GET" or isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        if status == 429:
+            return True
+        if status >= 500:
+            return method == "GET" or status == 503
+        return False
+
+    async def request(self, method, send, on_retry=None):
+        # send() performs one HTTP attempt and returns the httpx response
+        priority = READ if method == "GET" else WRITE
+        attempt = 0
+        while True:
+            trial = self.breaker.before_call()
+            try:
+                await self.acquire(priority)
+            except BaseException:
+                # a trial cancelled while queued for a token never reached GHL;
+                # holding on to it would keep the circuit half open for good
+                if trial:
+                    self.breaker.release()
+                raise
+            self.calls += 1
+            try:
+                response = await send()
+            except (asyncio.CancelledError, Exception) as e:
+                if not isinstance(e, httpx.TransportError):
+                    if trial:
+                        self.breaker.release()
+                    raise
+                self.transport_errors += 1
+                self.breaker.failure()
+                if attempt >= self.max_retries or not self._retryable(method, error=e):
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                status = response.status_code
+                if status == 429:
+                    self.throttled += 1
+                    if trial:
+                        self.breaker.release()
+                    delay = retry_after_seconds(response)
+                    delay = self._backoff(attempt) if delay is None else delay + random.uniform(0, 0.5)
+                    await self.bucket.pause(delay)
+                elif status >= 500:
+                    self.server_errors += 1
+                    self.breaker.failure()
+                    delay = retry_after_seconds(response) or self._backoff(attempt)
+                else:
+                    self.breaker.success()
+                    return response
+                if attempt >= self.max_retries or not self._retryable(method, status=status):
+                    return response
+            attempt += 1
+            self.retries += 1
+            if on_retry is not None:
+                on_retry()
+            action_logger.info(f"Retrying GHL {method} in {delay:.2f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "transport_errors": self.transport_errors,
+            "queued": len(self._waiters),
+            "queue_wait_total_seconds": self.wait_total,
+            "queue_wait_max_seconds": self.wait_max,
+            "circuit_state": self.breaker.state,
+            "circuit_rejected": self.breaker.rejected,
+        }
+
+
+def create_scheduler(settings, backend: CacheBackend):
+    # burst + rate * window never exceeds the GHL limit for any window; with a
+    # shared backend that holds for all workers together, not for each one
+    rate = (settings.ghl_rate_limit - settings.ghl_burst) / settings.ghl_rate_window
+    return GHLScheduler(
+        rate=rate,
+        burst=settings.ghl_burst,
+        bucket=SharedTokenBucket(backend, rate, settings.ghl_burst) if backend.shared else None,
+        max_retries=settings.ghl_max_retries,
+        breaker=CircuitBreaker(
+            threshold=settings.ghl_circuit_threshold,
+            reset_timeout=settings.ghl_circuit_reset,
+        ),
+    )
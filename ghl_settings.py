@@ -0,0 +1,150 @@
+import os
+from typing import Literal, Optional
+
+import httpx
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field, ValidationError, model_validator
+
+from ghl_logging import *
+
+
+#--------------------------
+#   SETTINGS
+# -------------------------
+class Settings(BaseModel):
+    # every field is read from the env var of the same name in upper case
+    api_key: str = Field(min_length=1)
+    ghl_url: str = "https://rest.gohighlevel.com"
+    slack_token: Optional[str] = None
+
+    # pipeline / stage / custom field mapping: the ids default to the ones
+    # the service has always used; a name overrides the id and is resolved
+    # once at startup
+    pipeline_id: Optional[str] = "UuhQYJN98JQKkWP0HcC6"
+    pipeline_name: Optional[str] = None
+    stage_id: Optional[str] = "0eaab081-3e7a-4b46-8b35-0fd7135c1540"
+    stage_name: Optional[str] = None
+    url_field_id: Optional[str] = "npIW2acDJLVxtzLav4pg"
+    url_field_name: Optional[str] = None
+
+    ghl_max_connections: int = Field(100, ge=1)
+    ghl_max_keepalive: int = Field(20, ge=0)
+    ghl_timeout: float = Field(30, gt=0)
+    ghl_rate_limit: float = Field(100, gt=0)
+    ghl_rate_window: float = Field(10, gt=0)
+    ghl_burst: int = Field(10, ge=1)
+    ghl_max_retries: int = Field(4, ge=0)
+    ghl_circuit_threshold: int = Field(5, ge=1)
+    ghl_circuit_reset: float = Field(30, gt=0)
+
+    cache_backend: Literal["memory", "sqlite"] = "memory"
+    cache_sqlite_path: str = "cache.sqlite3"
+    cache_size: int = Field(10000, ge=1)
+    contact_cache_ttl: float = Field(900, ge=0)
+    # seconds between background reloads of the full opportunity listing
+    opportunity_index_ttl: float = Field(300, ge=0)
+    idempotency_window_minutes: float = Field(10, ge=0)
+
+    # uvicorn worker processes; more than one needs the shared sqlite backend
+    workers: int = Field(1, ge=1)
+    shutdown_timeout: float = Field(30, ge=0)
+    lead_lease_ttl: float = Field(120, gt=0)
+    # where the workers add up their prometheus samples; a new temp dir if unset
+    prometheus_multiproc_dir: Optional[str] = None
+
+    webhook_mode: Literal["sync", "queue"] = "sync"
+    queue_sqlite_path: str = "queue.sqlite3"
+    queue_workers: int = Field(4, ge=1)
+    queue_max_attempts: int = Field(3, ge=1)
+    # first retry delay of a failed job, doubled for each further attempt
+    queue_retry_delay: float = Field(30, ge=0)
+    pipeline_step_timeout: float = Field(30, gt=0)
+
+    slack_flush_interval: float = Field(10, gt=0)
+    slack_max_per_hour: int = Field(30, ge=0)
+
+    # log files are rotated by size (LOG_MAX_BYTES) or by time (LOG_ROTATE_WHEN)
+    log_dir: str = "logs"
+    log_rotation: Literal["size", "time"] = "size"
+    log_max_bytes: int = Field(10 * 1024 * 1024, ge=0)
+    log_rotate_when: str = "midnight"
+    log_backup_count: int = Field(10, ge=0)
+    log_console: bool = True
+
+    @model_validator(mode="after")
+    def check(self):
+        for name in ("pipeline", "stage", "url_field"):
+            if not getattr(self, f"{name}_id") and not getattr(self, f"{name}_name"):
+                raise ValueError(f"set {name.upper()}_ID or {name.upper()}_NAME")
+        if self.pipeline_name and not self.stage_name and "stage_id" not in self.model_fields_set:
+            # the default stage belongs to the default pipeline
+            raise ValueError("PIPELINE_NAME needs STAGE_NAME or STAGE_ID")
+        if self.ghl_burst >= self.ghl_rate_limit:
+            raise ValueError("GHL_BURST must be below GHL_RATE_LIMIT")
+        if self.workers > 1 and self.cache_backend != "sqlite":
+            # per-process caches would split the rate limit and dedup state
+            raise ValueError("WORKERS > 1 needs CACHE_BACKEND=sqlite")
+        return self
+
+    @property
+    def needs_resolving(self):
+        return bool(self.pipeline_name or self.stage_name or self.url_field_name)
+
+    @classmethod
+    def from_env(cls, **overrides):
+        load_dotenv()
+        values = {name: os.environ[name.upper()] for name in cls.model_fields if name.upper() in os.environ}
+        return cls.model_validate({**values, **overrides})
+
+    @property
+    def ghl_headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Version": "2021-04-15",
+            "Content-Type": "application/json"
+        }
+
+
+class SettingsError(Exception):
+    pass
+
+
+def load_settings(**overrides):
+    try:
+        return Settings.from_env(**overrides)
+    except ValidationError as e:
+        raise SettingsError(f"Invalid configuration: {e}") from None
+
+
+#--------------------------
+#   ID RESOLUTION
+# -------------------------
+async def resolve_ids(settings: Settings, client: httpx.AsyncClient):
+    # the same pipelines call get_pipeline_id.py makes by hand, done once at boot
+    pipeline_id, stage_id, url_field_id = settings.pipeline_id, settings.stage_id, settings.url_field_id
+    if settings.pipeline_name or settings.stage_name:
+        response = await client.get(f"{settings.ghl_url}/v1/pipelines/", headers=settings.ghl_headers)
+        response.raise_for_status()
+        pipelines = response.json().get("pipelines", [])
+        if settings.pipeline_name:
+            pipeline = next((p for p in pipelines if p.get("name") == settings.pipeline_name), None)
+        else:
+            pipeline = next((p for p in pipelines if p.get("id") == pipeline_id), None)
+        if pipeline is None:
+            raise SettingsError(f"Pipeline {settings.pipeline_name or pipeline_id!r} not found in GHL")
+        pipeline_id = pipeline["id"]
+        if settings.stage_name:
+            stage = next((s for s in pipeline.get("stages", []) if s.get("name") == settings.stage_name), None)
+            if stage is None:
+                raise SettingsError(f"Stage {settings.stage_name!r} not found in pipeline {pipeline['name']!r}")
+            stage_id = stage["id"]
+    if settings.url_field_name:
+        response = await client.get(f"{settings.ghl_url}/v1/custom-fields/", headers=settings.ghl_headers)
+        response.raise_for_status()
+        fields = response.json().get("customFields", [])
+        field = next((f for f in fields if f.get("name") == settings.url_field_name), None)
+        if field is None:
+            raise SettingsError(f"Custom field {settings.url_field_name!r} not found in GHL")
+        url_field_id = field["id"]
+    action_logger.info(f"Using pipeline {pipeline_id}, stage {stage_id}, url field {url_field_id}")
+    return settings.model_copy(update={"pipeline_id": pipeline_id, "stage_id": stage_id, "url_field_id": url_field_id})
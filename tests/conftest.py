@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# the modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# keep test runs out of the service's log files
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="ghl-test-logs-"))
+os.environ.setdefault("LOG_CONSOLE", "0")
@@ -0,0 +1,52 @@
+import asyncio
+
+from ghl_cache import ContactCache, MemoryBackend, SqliteBackend, normalize_phone
+
+
+def test_normalize_phone():
+    assert normalize_phone("(555) 123-4567") == "+15551234567"
+    assert normalize_phone("+44 20 7946 0958") == "+442079460958"
+    assert normalize_phone("") is None
+
+
+def test_contact_cache_finds_contact_by_email_and_phone():
+    async def scenario():
+        cache = ContactCache(MemoryBackend())
+        await cache.remember({"id": "c1", "email": "A@x.com", "phone": "5551234567", "name": "A"})
+        assert (await cache.get_by_email("a@x.com"))["id"] == "c1"
+        assert (await cache.get_by_phone("+1 555 123 4567"))["id"] == "c1"
+
+    asyncio.run(scenario())
+
+
+def test_forget_id_drops_every_key(tmp_path):
+    async def scenario(backend):
+        cache = ContactCache(backend)
+        await cache.remember({"id": "c1", "email": "a@x.com", "phone": "5551234567"})
+        await cache.remember({"id": "c1"}, phone="5550000000")
+        await cache.forget_id("c1")
+        assert await cache.get_by_email("a@x.com") is None
+        assert await cache.get_by_phone("5551234567") is None
+        assert await cache.get_by_phone("5550000000") is None
+
+    for backend in (MemoryBackend(), SqliteBackend(str(tmp_path / "cache.sqlite3"))):
+        asyncio.run(scenario(backend))
+
+
+def test_size_limit_never_evicts_coordination_keys(tmp_path):
+    memory = MemoryBackend(maxsize=2)
+    memory.set("lease:lead:a", "w1", 60)
+    for n in range(5):
+        memory.set(f"contact:email:{n}@x.com", {"id": n}, 60)
+    assert memory.get("lease:lead:a") == "w1"
+    assert memory.get("contact:email:0@x.com") is None
+    assert memory.get("contact:email:4@x.com") == {"id": 4}
+
+    sqlite = SqliteBackend(str(tmp_path / "cache.sqlite3"), maxsize=2)
+    sqlite.set("idempotency:big_form:k", {"status": "ok"}, 1)
+    for n in range(5):
+        sqlite.set(f"contact:email:{n}@x.com", {"id": n}, 60 + n)
+    sqlite._prune()
+    assert sqlite.get("idempotency:big_form:k") == {"status": "ok"}
+    assert sqlite.get("contact:email:0@x.com") is None
+    assert sqlite.get("contact:email:4@x.com") == {"id": 4}
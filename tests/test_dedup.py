@@ -0,0 +1,101 @@
+import asyncio
+
+from ghl_cache import MemoryBackend, SqliteBackend
+from ghl_dedup import LeadDeduplicator
+
+LEAD = {"event": "form", "data": {"email": "a@x.com", "name": "A", "phone": "5551234567"}}
+
+
+def submission(name):
+    return {**LEAD, "data": {**LEAD["data"], "name": name}}
+
+
+class Pipeline:
+    # records how often it ran and how many runs overlapped
+    def __init__(self, status="ok", calls=3, duration=0.05):
+        self.status = status
+        self.calls = calls
+        self.duration = duration
+        self.runs = []
+        self.active = 0
+        self.max_active = 0
+
+    def __call__(self, name):
+        async def pipeline():
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.runs.append(name)
+            await asyncio.sleep(self.duration)
+            self.active -= 1
+            return {"status": self.status}, self.calls
+        return pipeline
+
+
+def test_identical_concurrent_payloads_run_once():
+    async def scenario():
+        dedup, pipeline = LeadDeduplicator(MemoryBackend()), Pipeline()
+        results = await asyncio.gather(*[dedup.run("webhook", LEAD, pipeline("A")) for _ in range(3)])
+        assert results == [{"status": "ok"}] * 3
+        assert pipeline.runs == ["A"]
+        assert dedup.stats() == {"coalesced": 2, "idempotent_hits": 0, "upstream_calls_saved": 6}
+        # and later ones are answered from the idempotency window
+        assert await dedup.run("webhook", LEAD, pipeline("A")) == {"status": "ok"}
+        assert pipeline.runs == ["A"]
+        assert dedup.stats()["idempotent_hits"] == 1
+        assert dedup._lead_locks == {} and dedup._inflight == {}
+
+    asyncio.run(scenario())
+
+
+def test_different_payloads_for_one_lead_run_in_sequence():
+    async def scenario():
+        dedup, pipeline = LeadDeduplicator(MemoryBackend()), Pipeline()
+        await asyncio.gather(*[dedup.run("webhook", submission(name), pipeline(name)) for name in "ABC"])
+        assert pipeline.runs == ["A", "B", "C"]
+        assert pipeline.max_active == 1
+        assert dedup._lead_locks == {}
+
+    asyncio.run(scenario())
+
+
+def test_lease_serialises_a_lead_across_workers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        workers = [LeadDeduplicator(SqliteBackend(path)) for _ in range(2)]
+        pipeline = Pipeline()
+        await asyncio.gather(*[
+            dedup.run("webhook", submission(name), pipeline(name)) for dedup, name in zip(workers, "AB")
+        ])
+        assert sorted(pipeline.runs) == ["A", "B"]
+        assert pipeline.max_active == 1
+        assert await workers[0].backend.aget("lease:lead:email:a@x.com") is None
+
+    asyncio.run(scenario())
+
+
+def test_error_results_are_not_cached():
+    async def scenario():
+        dedup, pipeline = LeadDeduplicator(MemoryBackend()), Pipeline(status="error")
+        for _ in range(2):
+            assert await dedup.run("webhook", LEAD, pipeline("A")) == {"status": "error"}
+        assert pipeline.runs == ["A", "A"]
+        assert dedup.stats()["idempotent_hits"] == 0
+        assert dedup._lead_locks == {}
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_pipeline():
+    async def scenario():
+        dedup, pipeline = LeadDeduplicator(MemoryBackend()), Pipeline(duration=0.1)
+        first = asyncio.create_task(dedup.run("webhook", LEAD, pipeline("A")))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(dedup.run("webhook", LEAD, pipeline("A")))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == {"status": "ok"}
+        assert pipeline.runs == ["A"] and pipeline.active == 0
+        assert dedup._lead_locks == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,25 @@
+import json
+
+from ghl_import import parse_record
+
+
+def test_parses_a_webhook_data_record():
+    kind, payload = parse_record(json.dumps({"event": "e", "data": {"phone": "5551234567"}}), "auto")
+    assert kind == "small_form"
+    assert payload.data == {"phone": "5551234567"}
+
+
+def test_parses_a_json_log_entry():
+    line = json.dumps({"message": "Received small form", "payload": {"event": "e", "data": {"email": "a@x.com"}}})
+    kind, payload = parse_record(line, "auto")
+    assert kind == "small_form"
+    assert payload.data == {"email": "a@x.com"}
+
+
+def test_parses_a_legacy_log_line():
+    line = ('2024-03-01 10:15:02,417 - Received webhook: 0b9e4c1e-6f1d-4c57-9a43-5d1f1c0e2a11 | '
+            '{"event":"form","data":{"email":"a@x.com","name":"A - B | C"},"utm_url":null}\n')
+    kind, payload = parse_record(line, "auto")
+    assert kind == "webhook"
+    assert payload.data == {"email": "a@x.com", "name": "A - B | C"}
+    assert parse_record(line, "small_form")[0] == "small_form"
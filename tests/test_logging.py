@@ -0,0 +1,19 @@
+import json
+import os
+
+from ghl_logging import action_logger, error_logger, start_logging, stop_logging
+from ghl_settings import Settings
+
+
+def test_handlers_follow_the_loaded_settings(tmp_path):
+    settings = Settings(api_key="k", pipeline_id="P1", stage_id="S1", url_field_id="F1", log_dir=str(tmp_path),
+                        log_console=False, workers=2, cache_backend="sqlite")
+    action_logger.info("before start")
+    start_logging(settings)
+    error_logger.error("after start")
+    stop_logging()
+    pid = os.getpid()
+    actions = [json.loads(line) for line in open(tmp_path / f"actions.{pid}.log")]
+    errors = [json.loads(line) for line in open(tmp_path / f"errors.{pid}.log")]
+    assert "before start" in [entry["message"] for entry in actions]
+    assert "after start" in [entry["message"] for entry in errors]
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+from ghl_metrics import StatsCollector
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_stats_are_labelled_with_the_worker_pid():
+    collector = StatsCollector(lambda: {"scheduler": {"calls": 3, "queued": 1, "circuit_state": "open"}})
+    metrics = {metric.name: metric for metric in collector.collect()}
+    assert metrics["ghl_scheduler_calls"].type == "counter"
+    assert metrics["ghl_scheduler_queued"].type == "gauge"
+    for metric in metrics.values():
+        assert metric.samples[0].labels == {"pid": str(os.getpid())}
+    assert metrics["ghl_scheduler_circuit_state"].samples[0].value == 2
+
+
+def test_multiprocess_metrics_add_up_every_worker(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    record = "from ghl_metrics import HANDLER_RESULTS; HANDLER_RESULTS.labels('big_form', 'ok').inc()"
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", record], cwd=HERE, env=env, check=True)
+    render = "from ghl_metrics import render_metrics; print(render_metrics()[0].decode())"
+    output = subprocess.run([sys.executable, "-c", render], cwd=HERE, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    assert 'webhook_requests_total{endpoint="big_form",status="ok"} 2.0' in output
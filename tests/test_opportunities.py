@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+
+import ghl
+from ghl_alerts import AlertDispatcher
+from ghl_cache import MemoryBackend, OpportunityIndex, SqliteBackend
+from ghl_scheduler import GHLScheduler
+from ghl_settings import Settings
+
+
+def make_api(handler, ttl):
+    settings = Settings(api_key="k", pipeline_id="P1", stage_id="S1", url_field_id="F1", opportunity_index_ttl=ttl)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return ghl.GoHighLevelAPI(settings, client, MemoryBackend(), GHLScheduler(), AlertDispatcher(client, None))
+
+
+def test_stale_index_is_served_while_it_reloads_in_the_background():
+    listings = []
+
+    async def handler(request):
+        listings.append(request.url.path)
+        if len(listings) > 1:
+            # the reload is slow; lookups must not wait for it
+            await asyncio.sleep(0.5)
+        deals = [{"id": f"d{len(listings)}", "contact": {"id": "c1"}}]
+        return httpx.Response(200, json={"opportunities": deals, "meta": {}})
+
+    async def scenario():
+        api = make_api(handler, ttl=0.05)
+        assert (await api.search_deal("c1"))["id"] == "d1"
+        await asyncio.sleep(0.1)
+        refresh = asyncio.create_task(ghl.refresh_opportunities(api))
+        await asyncio.sleep(0.05)
+        started = asyncio.get_running_loop().time()
+        assert (await api.search_deal("c1"))["id"] == "d1"
+        assert asyncio.get_running_loop().time() - started < 0.1
+        await asyncio.sleep(0.6)
+        assert (await api.search_deal("c1"))["id"] == "d2"
+        refresh.cancel()
+        await api.client.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_deal_created_during_a_reload_survives_it():
+    release = asyncio.Event()
+
+    async def handler(request):
+        if request.method == "GET":
+            await release.wait()
+            return httpx.Response(200, json={"opportunities": [], "meta": {}})
+        return httpx.Response(200, json={"id": "d9", "contact": {"id": "c9"}})
+
+    async def scenario():
+        api = make_api(handler, ttl=300)
+        reload = asyncio.create_task(api.load_opportunities())
+        await asyncio.sleep(0.05)
+        await api.create_deal("c9", "a@x.com", "A")
+        release.set()
+        await reload
+        assert (await api.search_deal("c9"))["id"] == "d9"
+        await api.client.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_deal_gone_from_ghl_is_dropped_on_update():
+    async def handler(request):
+        if request.method == "GET":
+            return httpx.Response(200, json={"opportunities": [{"id": "d1", "contact": {"id": "c1"}}], "meta": {}})
+        return httpx.Response(404, json={"msg": "Opportunity not found"})
+
+    async def scenario():
+        api = make_api(handler, ttl=300)
+        assert (await api.search_deal("c1"))["id"] == "d1"
+        assert await api.update_deal("d1", "c1", "a@x.com", "A") is None
+        assert await api.search_deal("c1") is None
+        await api.client.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_shared_entries_only_win_when_newer_than_the_listing(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        mine, other = OpportunityIndex(SqliteBackend(path)), OpportunityIndex(SqliteBackend(path))
+        await other.put("c1", {"id": "old"})
+        mine.replace([{"id": "listed", "contact": {"id": "c1"}}], listed_at=mine.begin_load())
+        assert (await mine.get("c1"))["id"] == "listed"
+        await other.drop("c1")
+        assert await mine.get("c1") is None
+        await other.put("c1", {"id": "new"})
+        assert (await mine.get("c1"))["id"] == "new"
+
+    asyncio.run(scenario())
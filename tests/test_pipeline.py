@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+from ghl_pipeline import Step, StepSkipped, remaining_steps, run_steps
+
+
+async def noop(results):
+    return None
+
+
+def test_retry_reruns_only_unfinished_steps_and_what_they_need():
+    steps = [
+        Step("update_contact", noop),
+        Step("search_deal", noop),
+        Step("save_deal", noop, after=["search_deal"]),
+        Step("add_notes", noop),
+    ]
+    names = [step.name for step in remaining_steps(steps, {"update_contact", "search_deal", "add_notes"})]
+    assert names == ["search_deal", "save_deal"]
+    assert remaining_steps(steps, {step.name for step in steps}) == []
+
+
+def sleeper(seconds, value=None, log=None):
+    async def run(results):
+        if log is not None:
+            log.append(time.monotonic())
+        await asyncio.sleep(seconds)
+        return value
+    return run
+
+
+def test_independent_steps_start_together_and_dependents_get_results():
+    starts = []
+
+    async def save(results):
+        return f"saved {results['search']}"
+
+    steps = [
+        Step("update", sleeper(0.1, "updated", starts)),
+        Step("search", sleeper(0.1, "deal", starts)),
+        Step("save", save, after=["search"]),
+    ]
+    started = time.monotonic()
+    results, errors = asyncio.run(run_steps(steps))
+    assert time.monotonic() - started < 0.18
+    assert max(starts) - min(starts) < 0.05
+    assert results == {"update": "updated", "search": "deal", "save": "saved deal"}
+    assert errors == {}
+
+
+def test_failed_dependency_skips_everything_after_it():
+    async def fail(results):
+        raise RuntimeError("GHL 500")
+
+    steps = [
+        Step("search", fail),
+        Step("save", sleeper(0), after=["search"]),
+        Step("notify", sleeper(0), after=["save"]),
+        Step("notes", sleeper(0, "noted")),
+    ]
+    results, errors = asyncio.run(run_steps(steps))
+    assert results == {"notes": "noted"}
+    assert isinstance(errors["search"], RuntimeError)
+    assert isinstance(errors["save"], StepSkipped) and "search failed" in str(errors["save"])
+    assert isinstance(errors["notify"], StepSkipped)
+
+
+def test_step_timeout_is_reported_and_leaves_siblings_alone():
+    steps = [
+        Step("slow", sleeper(1), timeout=0.05),
+        Step("after_slow", sleeper(0), after=["slow"]),
+        Step("sibling", sleeper(0.1, "done")),
+    ]
+    started = time.monotonic()
+    results, errors = asyncio.run(run_steps(steps, timeout=5))
+    assert time.monotonic() - started < 0.5
+    assert results == {"sibling": "done"}
+    assert isinstance(errors["slow"], asyncio.TimeoutError) and "timed out after 0.05s" in str(errors["slow"])
+    assert isinstance(errors["after_slow"], StepSkipped)
+
+
+def test_cancelling_the_caller_cancels_running_steps():
+    cancelled = []
+
+    def step(name):
+        async def run(results):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+        return Step(name, run)
+
+    async def scenario():
+        task = asyncio.create_task(run_steps([step("update"), step("notes")]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert sorted(cancelled) == ["notes", "update"]
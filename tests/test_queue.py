@@ -0,0 +1,84 @@
+import asyncio
+
+from ghl_queue import JobQueue, JobWorkers
+
+
+def run_workers(queue, handler, seconds=0.5, **kwargs):
+    async def scenario():
+        workers = JobWorkers(queue, handler, concurrency=1, poll_interval=0.01, **kwargs)
+        workers.start()
+        await asyncio.sleep(seconds)
+        await workers.stop()
+
+    asyncio.run(scenario())
+
+
+def status(queue, job_id):
+    return queue._conn.execute("SELECT status, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_error_result_is_retried_until_it_succeeds(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=3)
+    job_id = queue.enqueue("webhook", "r1", "{}")
+    results = iter([{"status": "error", "message": "503"}, {"status": "partial", "failed": {}}, {"status": "ok"}])
+
+    async def handler(kind, request_id, payload, completed):
+        return next(results)
+
+    run_workers(queue, handler, retry_delay=0.0)
+    assert status(queue, job_id) == ("done", 3)
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=2)
+    job_id = queue.enqueue("webhook", "r1", "{}")
+
+    async def handler(kind, request_id, payload, completed):
+        raise RuntimeError("boom")
+
+    run_workers(queue, handler, retry_delay=0.0)
+    assert status(queue, job_id) == ("failed", 2)
+    assert queue.stats()["failed"] == 1
+
+
+def test_retry_waits_for_its_delay(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=3)
+    job_id = queue.enqueue("webhook", "r1", "{}")
+
+    async def handler(kind, request_id, payload, completed):
+        return {"status": "error", "message": "circuit open"}
+
+    run_workers(queue, handler, seconds=0.2, retry_delay=60.0)
+    assert status(queue, job_id) == ("pending", 1)
+    assert queue.claim() is None
+    assert queue.stats()["delayed"] == 1
+
+
+def test_partial_retry_skips_the_steps_already_done(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=3)
+    job_id = queue.enqueue("webhook", "r1", "{}")
+    results = iter([
+        {"status": "partial", "failed": {"save_deal": "404"}, "completed": ["add_notes", "search_deal"]},
+        {"status": "partial", "failed": {"save_deal": "404"}, "completed": ["search_deal", "update_contact"]},
+        {"status": "ok"},
+    ])
+    seen = []
+
+    async def handler(kind, request_id, payload, completed):
+        seen.append(completed)
+        return next(results)
+
+    run_workers(queue, handler, retry_delay=0.0)
+    assert status(queue, job_id) == ("done", 3)
+    assert seen == [[], ["add_notes", "search_deal"], ["add_notes", "search_deal", "update_contact"]]
+
+
+def test_invalid_payload_is_not_retried(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=3)
+    job_id = queue.enqueue("webhook", "r1", "{}")
+
+    async def handler(kind, request_id, payload, completed):
+        return {"status": "invalid", "message": "payload is missing email"}
+
+    run_workers(queue, handler, retry_delay=0.0)
+    assert status(queue, job_id) == ("failed", 1)
@@ -0,0 +1,168 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ghl_cache import SqliteBackend
+from ghl_scheduler import (CircuitBreaker, CircuitOpenError, GHLScheduler, SharedTokenBucket, TokenBucket,
+                           retry_after_seconds)
+
+
+def responses(*statuses, headers=None):
+    # send() stand-in answering with the given status codes in turn
+    sent = []
+
+    async def send():
+        status = statuses[min(len(sent), len(statuses) - 1)]
+        sent.append(status)
+        return httpx.Response(status, headers=headers or {})
+
+    return send, sent
+
+
+def scheduler(**kwargs):
+    kwargs.setdefault("rate", 1000.0)
+    kwargs.setdefault("burst", 100)
+    kwargs.setdefault("base_delay", 0.0)
+    return GHLScheduler(**kwargs)
+
+
+#--------------------------
+#   TOKEN BUCKET
+# -------------------------
+def test_bucket_serves_burst_then_asks_to_wait():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert asyncio.run(bucket.take()) == 0.0
+    assert asyncio.run(bucket.take()) == 0.0
+    assert 0 < asyncio.run(bucket.take()) <= 0.1
+
+
+def test_bucket_pause_blocks_and_refund_returns_token():
+    bucket = TokenBucket(rate=10, capacity=2)
+    asyncio.run(bucket.pause(5))
+    assert asyncio.run(bucket.take()) > 4.9
+    bucket = TokenBucket(rate=10, capacity=1)
+    assert asyncio.run(bucket.take()) == 0.0
+    asyncio.run(bucket.refund())
+    assert asyncio.run(bucket.take()) == 0.0
+
+
+def test_shared_bucket_is_one_budget_for_every_worker(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = SharedTokenBucket(SqliteBackend(path), rate=0.001, capacity=3)
+    second = SharedTokenBucket(SqliteBackend(path), rate=0.001, capacity=3)
+
+    async def takes():
+        return [await bucket.take() for bucket in (first, second, first, second)]
+
+    waits = asyncio.run(takes())
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] > 0
+
+
+def test_retry_after_header():
+    assert retry_after_seconds(httpx.Response(429, headers={"Retry-After": "3"})) == 3.0
+    assert retry_after_seconds(httpx.Response(429)) is None
+
+
+#--------------------------
+#   RETRIES
+# -------------------------
+def test_read_retries_server_errors():
+    send, sent = responses(500, 502, 200)
+    response = asyncio.run(scheduler().request("GET", send))
+    assert response.status_code == 200
+    assert sent == [500, 502, 200]
+
+
+def test_write_retries_only_503():
+    send, sent = responses(500)
+    assert asyncio.run(scheduler().request("POST", send)).status_code == 500
+    assert sent == [500]
+    send, sent = responses(503, 201)
+    assert asyncio.run(scheduler().request("POST", send)).status_code == 201
+    assert sent == [503, 201]
+
+
+def test_throttled_call_pauses_bucket_and_retries():
+    send, sent = responses(429, 200, headers={"Retry-After": "0"})
+    ghl = scheduler()
+    assert asyncio.run(ghl.request("POST", send)).status_code == 200
+    assert ghl.throttled == 1 and ghl.retries == 1
+
+
+def test_gives_up_after_max_retries():
+    send, sent = responses(503)
+    assert asyncio.run(scheduler(max_retries=2).request("GET", send)).status_code == 503
+    assert len(sent) == 3
+
+
+#--------------------------
+#   CIRCUIT BREAKER
+# -------------------------
+def test_breaker_opens_then_lets_one_trial_through():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+def test_open_circuit_rejects_without_calling():
+    send, sent = responses(503)
+    ghl = scheduler(max_retries=0, breaker=CircuitBreaker(threshold=1, reset_timeout=60))
+    asyncio.run(ghl.request("GET", send))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(ghl.request("GET", send))
+    assert len(sent) == 1
+
+
+def test_trial_cancelled_while_queued_releases_circuit():
+    async def scenario():
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        ghl = scheduler(rate=1.0, burst=1, max_retries=0, breaker=breaker)
+        send, sent = responses(503)
+        await ghl.request("GET", send)
+        await asyncio.sleep(0.02)
+        # the bucket is empty, so the half-open trial waits for a token
+        trial = asyncio.create_task(ghl.request("GET", send))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert breaker.trial_in_flight is False
+        await ghl.bucket.refund()
+        ok, _ = responses(200)
+        assert (await ghl.request("GET", ok)).status_code == 200
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_trial_cancelled_during_send_releases_circuit():
+    async def scenario():
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        ghl = scheduler(max_retries=0, breaker=breaker)
+        send, _ = responses(503)
+        await ghl.request("GET", send)
+        await asyncio.sleep(0.02)
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        trial = asyncio.create_task(ghl.request("GET", hang))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert breaker.trial_in_flight is False
+
+    asyncio.run(scenario())
@@ -0,0 +1,19 @@
+import pytest
+from pydantic import ValidationError
+
+from ghl_settings import Settings
+
+
+def test_api_key_alone_keeps_the_original_ids():
+    settings = Settings(api_key="k")
+    assert settings.pipeline_id == "UuhQYJN98JQKkWP0HcC6"
+    assert settings.stage_id == "0eaab081-3e7a-4b46-8b35-0fd7135c1540"
+    assert settings.url_field_id == "npIW2acDJLVxtzLav4pg"
+    assert not settings.needs_resolving
+
+
+def test_names_are_an_opt_in_override():
+    assert Settings(api_key="k", url_field_name="UTM URL").needs_resolving
+    assert Settings(api_key="k", pipeline_name="Leads", stage_name="New").needs_resolving
+    with pytest.raises(ValidationError, match="PIPELINE_NAME needs STAGE_NAME or STAGE_ID"):
+        Settings(api_key="k", pipeline_name="Leads")